@@ -1,4 +1,22 @@
 from healthrex_ml.datasets.starr_datasets import (
     custom_collate,
-    SequenceDataset
+    flat_collate,
+    SequenceDataset,
+    CachedSequenceDataset,
+    PackedSequenceDataset,
+    pack_sequences,
+    BucketBatchSampler,
+    load_sequence_index
+)
+from healthrex_ml.datasets.artifacts import (
+    load_csr,
+    load_features,
+    load_table,
+    save_csr,
+    save_table
+)
+from healthrex_ml.datasets.splits import (
+    temporal_validation_mask,
+    load_or_create_split,
+    split_path
 )
@@ -0,0 +1,101 @@
+"""
+Definition of the artifact formats featurizers write and trainers read.
+    'npz': compressed scipy save_npz matrices and csv tables (default)
+    'npy': uncompressed, memory mappable arrays and parquet tables. A csr
+        matrix {name} is saved as {name}/data.npy, {name}/indices.npy,
+        {name}/indptr.npy and {name}/shape.npy, tables as {name}.parquet.
+Loaders pick up whichever format is present in the working directory.
+"""
+import os
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse import load_npz
+from scipy.sparse import save_npz
+
+ARTIFACT_FORMATS = ('npz', 'npy')
+
+
+def as_float32_csr(csr):
+    """
+    Casts a csr matrix to float32 data and int32 indices, keeping int64
+    indices only when nnz or shape need them. Halves the memory of float64
+    matrices handed to LightGBM and sklearn.
+    """
+    csr = csr_matrix(csr).astype(np.float32, copy=False)
+    if max(csr.nnz, *csr.shape) < np.iinfo(np.int32).max:
+        csr.indices = csr.indices.astype(np.int32, copy=False)
+        csr.indptr = csr.indptr.astype(np.int32, copy=False)
+    return csr
+
+
+def save_csr(csr, working_dir, name, artifact_format='npz'):
+    """
+    Saves csr matrix as {name}.npz or as raw component arrays in {name}/
+    """
+    if artifact_format not in ARTIFACT_FORMATS:
+        raise ValueError(f"artifact_format must be one of {ARTIFACT_FORMATS}")
+    if artifact_format == 'npz':
+        save_npz(os.path.join(working_dir, f'{name}.npz'), csr)
+        return
+    csr_dir = os.path.join(working_dir, name)
+    os.makedirs(csr_dir, exist_ok=True)
+    np.save(os.path.join(csr_dir, 'data.npy'), csr.data)
+    np.save(os.path.join(csr_dir, 'indices.npy'), csr.indices)
+    np.save(os.path.join(csr_dir, 'indptr.npy'), csr.indptr)
+    np.save(os.path.join(csr_dir, 'shape.npy'), np.array(csr.shape))
+
+
+def load_csr(working_dir, name, mmap_mode='r'):
+    """
+    Loads csr matrix saved by save_csr as float32. Raw component arrays are
+    memory mapped, so nothing is decompressed or copied until rows are sliced.
+    """
+    csr_dir = os.path.join(working_dir, name)
+    if os.path.isdir(csr_dir):
+        data = np.load(os.path.join(csr_dir, 'data.npy'), mmap_mode=mmap_mode)
+        indices = np.load(os.path.join(csr_dir, 'indices.npy'),
+                          mmap_mode=mmap_mode)
+        indptr = np.load(os.path.join(csr_dir, 'indptr.npy'),
+                         mmap_mode=mmap_mode)
+        shape = tuple(np.load(os.path.join(csr_dir, 'shape.npy')))
+        csr = csr_matrix((data, indices, indptr), shape=shape, copy=False)
+    else:
+        csr = load_npz(os.path.join(working_dir, f'{name}.npz'))
+    return as_float32_csr(csr)
+
+
+def save_table(df, working_dir, name, artifact_format='npz'):
+    """
+    Saves dataframe as {name}.csv or {name}.parquet
+    """
+    if artifact_format not in ARTIFACT_FORMATS:
+        raise ValueError(f"artifact_format must be one of {ARTIFACT_FORMATS}")
+    if artifact_format == 'npz':
+        df.to_csv(os.path.join(working_dir, f'{name}.csv'), index=None)
+    else:
+        df.to_parquet(os.path.join(working_dir, f'{name}.parquet'),
+                      index=False)
+
+
+def load_table(working_dir, name, **kwargs):
+    """
+    Loads dataframe saved by save_table, preferring parquet. kwargs are
+    passed to pd.read_csv when falling back to csv.
+    """
+    parquet_path = os.path.join(working_dir, f'{name}.parquet')
+    if os.path.exists(parquet_path):
+        return pd.read_parquet(parquet_path)
+    return pd.read_csv(os.path.join(working_dir, f'{name}.csv'), **kwargs)
+
+
+def load_features(working_dir, split, use_svd=False):
+    """
+    Reads the feature matrix of split ('train' or 'test') saved by a
+    featurizer as float32 with int32 indices, so row slicing in the trainers
+    copies float32 data. If use_svd, reads the dense svd compressed features.
+    """
+    if use_svd:
+        return np.load(os.path.join(working_dir, f'{split}_features_svd.npy'),
+                       mmap_mode='r').astype(np.float32, copy=False)
+    return load_csr(working_dir, f'{split}_features')
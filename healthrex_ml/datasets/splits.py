@@ -0,0 +1,93 @@
+"""
+Time ordered validation holdouts for the sklearn trainers, computed with
+vectorized masks and persisted to the working directory so every trainer
+and task reuses the identical split.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+def split_path(working_dir, val_fraction=0.15, time_column='index_time',
+               group_column=None):
+    """
+    Path of the split saved for these arguments, ex
+    validation_split_index_time_0.15_anon_id.npz. Trainers with different
+    split arguments in one working_dir keep separate files.
+    """
+    return os.path.join(
+        working_dir, f"validation_split_{time_column}_{val_fraction}_"
+                     f"{group_column or 'rows'}.npz")
+
+
+def temporal_validation_mask(labels, val_fraction=0.15,
+                             time_column='index_time', group_column=None):
+    """
+    Boolean mask of the most recent val_fraction of rows of labels.
+    Args:
+        labels: dataframe with time_column (and group_column if given)
+        val_fraction: fraction of rows held out for validation
+        time_column: column rows are ordered by, most recent held out
+        group_column: if given (ex 'anon_id') whole groups are held out,
+            ordered by their most recent row, so no patient has rows in both
+            train and validation. Holds out groups until at least val_size
+            rows are covered.
+    """
+    num_rows = len(labels)
+    val_size = int(num_rows * val_fraction)
+    val_mask = np.zeros(num_rows, dtype=bool)
+    if val_size == 0:
+        return val_mask
+    times = pd.to_datetime(labels[time_column]).values
+    if group_column is None:
+        # Stable so ties keep row order
+        order = np.argsort(-times.astype(np.int64), kind='stable')
+        val_mask[order[:val_size]] = True
+        return val_mask
+
+    groups, group_ids = np.unique(labels[group_column].values,
+                                  return_inverse=True)
+    last_time = np.full(len(groups), np.iinfo(np.int64).min)
+    np.maximum.at(last_time, group_ids, times.astype(np.int64))
+    group_sizes = np.bincount(group_ids, minlength=len(groups))
+    group_order = np.argsort(-last_time, kind='stable')
+    rows_before = np.cumsum(group_sizes[group_order]) - \
+        group_sizes[group_order]
+    val_groups = np.zeros(len(groups), dtype=bool)
+    val_groups[group_order[rows_before < val_size]] = True
+    return val_groups[group_ids]
+
+
+def load_or_create_split(working_dir, labels, val_fraction=0.15,
+                         time_column='index_time', group_column=None):
+    """
+    Train and validation masks over the rows of labels (train_labels of a
+    featurizer). Indices are saved to split_path(...) in working_dir and
+    reused while they match labels, so all tasks and trainers with the same
+    split arguments use one split. Tasks drop their unlabeled rows from both
+    masks.
+    Returns:
+        train_mask, val_mask
+    """
+    path = split_path(working_dir, val_fraction, time_column, group_column)
+    params = np.array([str(val_fraction), time_column, str(group_column)])
+    observation_ids = labels['observation_id'].values
+    if os.path.exists(path):
+        split = np.load(path, allow_pickle=False)
+        if np.array_equal(split['params'], params) and \
+                split['num_rows'] == len(labels) and \
+                np.array_equal(split['val_observation_ids'].astype(str),
+                               observation_ids[split['val_inds']].astype(str)):
+            val_mask = np.zeros(len(labels), dtype=bool)
+            val_mask[split['val_inds']] = True
+            return ~val_mask, val_mask
+
+    val_mask = temporal_validation_mask(labels, val_fraction, time_column,
+                                        group_column)
+    val_inds = np.flatnonzero(val_mask)
+    # Write then rename so concurrent trainers never read a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, train_inds=np.flatnonzero(~val_mask),
+             val_inds=val_inds, num_rows=len(labels), params=params,
+             val_observation_ids=observation_ids[val_inds].astype(str))
+    os.replace(tmp_path, path)
+    return ~val_mask, val_mask
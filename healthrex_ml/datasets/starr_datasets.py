@@ -1,9 +1,25 @@
+from collections import OrderedDict
+import math
+import os
+import threading
 import numpy as np
+import pandas as pd
 import torch
 from torch.nn.utils.rnn import pad_sequence
+from tqdm import tqdm
 
 import pdb
 
+def collate_time_deltas(data):
+    """
+    Pads the days from index_time of each sequence to (B, N_max), None if the
+    samples don't have them
+    """
+    if any([d.get('time_deltas') is None for d in data]):
+        return None
+    return pad_sequence([torch.as_tensor(d['time_deltas'], dtype=torch.long)
+                         for d in data], batch_first=True)
+
 # Needed to batch data with variable length inputs
 def custom_collate(data):
     """
@@ -12,7 +28,8 @@ def custom_collate(data):
 
     Want sequence to have shape (B, N_max, S_max) where B is batch size
     N_max is max number of days in each batch, S_max is max number of tokens
-    within a day for each batch 
+    within a day for each batch. time_deltas are padded to (B, N_max).
+    index holds the dataset index of each sample.
     """
     inputs = [d['sequence'] for d in data]
     labels = [torch.tensor(d['labels']) for d in data]
@@ -25,7 +42,36 @@ def custom_collate(data):
     return {
         'sequence': inputs_padded,
         'labels': torch.tensor([lab[0][0] for lab in labels]),  # refactor
-        'lengths': patient_lens
+        'lengths': patient_lens,
+        'time_deltas': collate_time_deltas(data),
+        'observation_id': [d.get('observation_id') for d in data],
+        'index': [d.get('index') for d in data]
+    }
+
+def flat_collate(data):
+    """
+    Padding free alternative to custom_collate. Tokens of every day in the
+    batch are concatenated into one 1-D tensor, with offsets giving the start
+    of each day (EmbeddingBag input, offsets) and lengths the number of days
+    of each patient. Padding tokens (0) are dropped. time_deltas are padded
+    to (B, N_max) as in custom_collate.
+    """
+    inputs = [d['sequence'] for d in data]
+    labels = [torch.tensor(d['labels']) for d in data]
+    patient_lens = [i.shape[0] for i in inputs]
+    masks = [inp != 0 for inp in inputs]
+    tokens = torch.cat([inp[mask] for inp, mask in zip(inputs, masks)])
+    day_lens = torch.cat([mask.sum(dim=1) for mask in masks])
+    offsets = torch.cumsum(day_lens, dim=0) - day_lens
+
+    return {
+        'sequence': tokens,
+        'offsets': offsets,
+        'labels': torch.tensor([lab[0][0] for lab in labels]),  # refactor
+        'lengths': patient_lens,
+        'time_deltas': collate_time_deltas(data),
+        'observation_id': [d.get('observation_id') for d in data],
+        'index': [d.get('index') for d in data]
     }
 
 class SequenceDataset(torch.utils.data.Dataset):
@@ -44,7 +90,8 @@ class SequenceDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, index):
         'Generates one sample of data'
-        data = torch.load(self.sequences[index])
+        # Featurizer files hold numpy labels and time deltas
+        data = torch.load(self.sequences[index], weights_only=False)
 
         # Select sample
         sequence = data['sequence']
@@ -52,5 +99,468 @@ class SequenceDataset(torch.utils.data.Dataset):
             labels = data['labels'][0]
         else:
             labels = data['labels']
+        # Files are saved as {observation_id}.pt
+        observation_id = os.path.splitext(
+            os.path.basename(self.sequences[index]))[0]
         return {'sequence': sequence,
-                'labels': labels.astype(int)}
+                'labels': labels.astype(int),
+                'time_deltas': data.get('time_deltas'),
+                'observation_id': observation_id,
+                'index': index}
+
+
+def sample_nbytes(sample):
+    """
+    Approximate memory held by a loaded sample
+    """
+    nbytes = 0
+    for value in sample.values():
+        if isinstance(value, torch.Tensor):
+            nbytes += value.element_size() * value.nelement()
+        elif isinstance(value, np.ndarray):
+            nbytes += value.nbytes
+    return nbytes
+
+
+class CachedSequenceDataset(SequenceDataset):
+    """
+    SequenceDataset that keeps loaded samples in memory so multi epoch
+    training reads each file once.
+        - cache_bytes bounds an LRU cache of samples.
+        - preload loads every sample up front and copies all sequences into
+          one flat tensor (plus offsets and shapes) in shared memory, so
+          forked DataLoader workers read the same copy through a single
+          shared memory file. Samples are views into it. labels and
+          time_deltas stay ordinary arrays each worker may copy.
+        - prefetch loads samples in a background thread, in dataset order,
+          until the cache is full.
+
+    With DataLoader(num_workers > 0) each worker has a private copy of the
+    cache (whatever was cached when it was started, then its own loads),
+    which is thrown away at the end of every epoch unless the DataLoader
+    has persistent_workers=True. The prefetch thread runs in the main
+    process only and its cache reaches workers only as of their start, so
+    prefer preload with workers. A forked worker replaces the lock it
+    inherited (the prefetch thread may have held it at fork time) on its
+    first access.
+    """
+
+    def __init__(self, sequences, one_label_per_sequence=False,
+                 cache_bytes=2**30, preload=False, prefetch=False):
+        """
+        Args:
+            sequences: list of paths to saved sequences
+            one_label_per_sequence: see SequenceDataset
+            cache_bytes: max bytes held by the LRU cache (ignored if preload)
+            preload: if true load all samples into shared memory now
+            prefetch: if true start a background thread filling the cache
+        """
+        super(CachedSequenceDataset, self).__init__(sequences,
+                                                    one_label_per_sequence)
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.preloaded = None
+        if preload:
+            self.preload()
+        elif prefetch:
+            self.prefetch_thread = threading.Thread(target=self._prefetch,
+                                                    daemon=True)
+            self.prefetch_thread.start()
+
+    def load_sample(self, index):
+        """
+        Reads one sample from disk, converting labels once
+        """
+        return super(CachedSequenceDataset, self).__getitem__(index)
+
+    def preload(self):
+        """
+        Loads every sample, moving the sequences into one shared flat tensor.
+        Sharing each sequence on its own would hold one open file descriptor
+        per sample.
+        """
+        self.preloaded = []
+        sequences = []
+        for index in tqdm(range(len(self))):
+            sample = self.load_sample(index)
+            sequences.append(sample.pop('sequence'))
+            self.preloaded.append(sample)
+        self.sequence_shapes = torch.tensor([list(seq.shape)
+                                             for seq in sequences])
+        sizes = torch.tensor([seq.numel() for seq in sequences])
+        self.sequence_offsets = torch.cumsum(sizes, dim=0) - sizes
+        self.sequence_tokens = torch.cat([seq.reshape(-1)
+                                          for seq in sequences])
+        for tensor in (self.sequence_tokens, self.sequence_offsets,
+                       self.sequence_shapes):
+            tensor.share_memory_()
+
+    def preloaded_sample(self, index):
+        """
+        Preloaded sample with its sequence as a view of the shared tensor
+        """
+        start = int(self.sequence_offsets[index])
+        num_days, num_tokens = self.sequence_shapes[index].tolist()
+        sample = dict(self.preloaded[index])
+        sample['sequence'] = self.sequence_tokens[
+            start:start + num_days * num_tokens].view(num_days, num_tokens)
+        return sample
+
+    def _cache_sample(self, index, sample):
+        """
+        Adds sample to the LRU cache, evicting least recently used samples
+        beyond cache_bytes. Caller holds the lock.
+        """
+        nbytes = sample_nbytes(sample)
+        if nbytes > self.cache_bytes or index in self.cache:
+            return
+        self.cache[index] = sample
+        self.cached_bytes += nbytes
+        while self.cached_bytes > self.cache_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= sample_nbytes(evicted)
+
+    def _prefetch(self):
+        for index in range(len(self)):
+            with self.lock:
+                if index in self.cache:
+                    continue
+            sample = self.load_sample(index)
+            with self.lock:
+                if self.cached_bytes + sample_nbytes(sample) > \
+                        self.cache_bytes:
+                    return
+                self._cache_sample(index, sample)
+
+    def _after_fork(self):
+        """
+        Called in a forked process (ex a DataLoader worker). Threads are not
+        copied by fork, so a lock the prefetch thread held at fork time is
+        never released and the cache it was editing may be inconsistent.
+        """
+        if self.lock.locked():
+            self.cache = OrderedDict()
+            self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def __getitem__(self, index):
+        'Generates one sample of data'
+        if self.preloaded is not None:
+            return self.preloaded_sample(index)
+        if self.pid != os.getpid():
+            self._after_fork()
+        with self.lock:
+            sample = self.cache.get(index)
+            if sample is not None:
+                self.cache.move_to_end(index)
+                return sample
+        sample = self.load_sample(index)
+        with self.lock:
+            self._cache_sample(index, sample)
+        return sample
+
+    def __getstate__(self):
+        # Locks and threads can't be pickled for spawned DataLoader workers
+        state = self.__dict__.copy()
+        state.pop('lock', None)
+        state.pop('prefetch_thread', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+
+PACKED_ARRAYS = ('tokens', 'day_offsets', 'patient_offsets', 'time_deltas',
+                 'labels', 'observation_ids')
+
+
+def pack_sequences(split_dir, packed_dir):
+    """
+    Packs the {observation_id}.pt files of a split directory into flat
+    arrays in packed_dir that PackedSequenceDataset memory maps:
+        tokens: non padding tokens of every day, concatenated
+        day_offsets: start of each day in tokens (num_days + 1)
+        patient_offsets: start of each observation in days (num_obs + 1)
+        time_deltas: days from index_time of every day
+        labels: labels of each observation (num_obs, num_labels)
+        observation_ids: observation id of each observation
+    """
+    os.makedirs(packed_dir, exist_ok=True)
+    df_index = load_sequence_index(split_dir)
+    tokens, day_lengths, num_days, time_deltas, labels, observation_ids = \
+        [], [], [], [], [], []
+    for path in tqdm(df_index.path.values):
+        data = torch.load(path, weights_only=False)
+        sequence = data['sequence'].numpy()
+        mask = sequence != 0
+        tokens.append(sequence[mask])
+        day_lengths.append(mask.sum(axis=1))
+        num_days.append(sequence.shape[0])
+        time_deltas.append(np.asarray(data['time_deltas'])[:sequence.shape[0]])
+        labels.append(np.asarray(data['labels'])[0])
+        observation_ids.append(os.path.splitext(os.path.basename(path))[0])
+    day_lengths = np.concatenate(day_lengths)
+    arrays = {
+        'tokens': np.concatenate(tokens).astype(np.int32),
+        'day_offsets': np.concatenate([[0], np.cumsum(day_lengths)]),
+        'patient_offsets': np.concatenate([[0], np.cumsum(num_days)]),
+        'time_deltas': np.concatenate(time_deltas).astype(np.int64),
+        'labels': np.stack(labels).astype(np.int64),
+        'observation_ids': np.array(observation_ids, dtype=str)
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(packed_dir, f'{name}.npy'), array)
+
+
+class PackedSequenceDataset(torch.utils.data.Dataset):
+    """
+    SequenceDataset over arrays written by pack_sequences. Arrays are memory
+    mapped, so any number of processes (DataLoader workers, search trials)
+    read one copy through the page cache. Samples have the same layout as
+    SequenceDataset samples.
+    """
+
+    def __init__(self, packed_dir):
+        'Initialization'
+        self.packed_dir = packed_dir
+        self.arrays = {
+            name: np.load(os.path.join(packed_dir, f'{name}.npy'),
+                          mmap_mode='r')
+            for name in PACKED_ARRAYS
+        }
+
+    def __len__(self):
+        'Denotes the total number of samples'
+        return len(self.arrays['patient_offsets']) - 1
+
+    def __getitem__(self, index):
+        'Generates one sample of data'
+        first_day, last_day = self.arrays['patient_offsets'][index:index + 2]
+        day_offsets = self.arrays['day_offsets'][first_day:last_day + 1]
+        day_lengths = np.diff(day_offsets)
+        sequence = np.zeros((len(day_lengths), max(day_lengths.max(), 1)),
+                            dtype=np.int64)
+        mask = np.arange(sequence.shape[1])[None, :] < day_lengths[:, None]
+        sequence[mask] = self.arrays['tokens'][day_offsets[0]:day_offsets[-1]]
+        return {'sequence': torch.from_numpy(sequence),
+                'labels': np.array(self.arrays['labels'][index])[None],
+                'time_deltas': np.array(
+                    self.arrays['time_deltas'][first_day:last_day]),
+                'observation_id': str(self.arrays['observation_ids'][index]),
+                'index': index}
+
+
+SEQUENCE_INDEX = 'index.csv'
+
+
+def sequence_index_row(path, sequence):
+    """
+    Lengths of one saved sequence of shape (num_days, max_tokens_per_day)
+    """
+    return {
+        'path': path,
+        'num_days': int(sequence.shape[0]),
+        'max_tokens_per_day': int(sequence.shape[1]) if sequence.dim() > 1
+                              else 0,
+        'num_tokens': int((sequence != 0).sum())
+    }
+
+
+def save_sequence_index(index, split_dir):
+    """
+    Writes list of sequence_index_row dicts to split_dir/index.csv
+    """
+    df_index = pd.DataFrame(index, columns=['path', 'num_days',
+                                            'max_tokens_per_day',
+                                            'num_tokens'])
+    df_index.to_csv(os.path.join(split_dir, SEQUENCE_INDEX), index=None)
+
+
+def load_sequence_index(split_dir):
+    """
+    Reads the sequence lengths index of a split directory written by
+    SequenceFeaturizer, building it once by loading every file if missing.
+    Returned paths are joined with split_dir, ex SequenceDataset(index.path)
+    """
+    index_path = os.path.join(split_dir, SEQUENCE_INDEX)
+    if not os.path.exists(index_path):
+        index = []
+        for path in tqdm(sorted(os.listdir(split_dir))):
+            if not path.endswith('.pt'):
+                continue
+            data = torch.load(os.path.join(split_dir, path),
+                              weights_only=False)
+            index.append(sequence_index_row(path, data['sequence']))
+        save_sequence_index(index, split_dir)
+    df_index = pd.read_csv(index_path)
+    df_index['path'] = [os.path.join(split_dir, p) for p in df_index.path]
+    return df_index
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that groups observations with similar (num_days,
+    max_tokens_per_day) so custom_collate pads little. Batches have a fixed
+    batch_size or, if max_tokens is given, are filled until the padded
+    batch volume B * N_max * S_max would exceed max_tokens (custom_collate),
+    or with num_tokens until the number of real tokens would exceed it
+    (flat_collate). Observations with equal lengths and the order of batches
+    are shuffled every epoch. Pair token budget batches with
+    SequenceTrainer(effective_batch_size=...) to keep the optimizer batch
+    size fixed.
+
+    For distributed training pass num_replicas and rank: every rank builds
+    the same batches from seed and epoch (set_epoch) and takes every
+    num_replicas-th one, with batches repeated (or dropped if drop_last) so
+    each rank gets the same number of batches.
+    """
+
+    def __init__(self, num_days, max_tokens_per_day, batch_size=None,
+                 max_tokens=None, shuffle=True, drop_last=False, seed=0,
+                 num_tokens=None, num_replicas=1, rank=0):
+        """
+        Args:
+            num_days: number of days of each observation in the dataset
+            max_tokens_per_day: max tokens in a day of each observation
+            batch_size: number of observations per batch
+            max_tokens: max padded tokens per batch, used instead of batch_size
+            shuffle: if true shuffle within equal lengths and batch order
+            drop_last: drop the last batch if smaller than batch_size
+            seed: seed of the shuffling generator
+            num_tokens: real tokens of each observation, if given max_tokens
+                budgets these instead of the padded volume
+            num_replicas: number of distributed ranks sharing the batches
+            rank: rank of this process
+        """
+        if (batch_size is None) == (max_tokens is None):
+            raise ValueError("Specify exactly one of batch_size, max_tokens")
+        self.num_days = np.asarray(num_days)
+        self.max_tokens_per_day = np.maximum(np.asarray(max_tokens_per_day), 1)
+        self.num_tokens = (np.asarray(num_tokens) if num_tokens is not None
+                           else None)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.generator = np.random.default_rng(seed)
+        # Batches of the next epoch, built ahead so len() matches what the
+        # next __iter__ yields (token budgets make the count vary by epoch)
+        self.batches = self._epoch_batches()
+
+    def _epoch_batches(self):
+        """
+        Batches of one epoch in the order they are yielded
+        """
+        if not self.shuffle:
+            return self._shard(
+                self._make_batches(np.arange(len(self.num_days))))
+        order = self.generator.permutation(len(self.num_days))
+        batches = self._make_batches(order)
+        return self._shard([batches[i]
+                            for i in self.generator.permutation(len(batches))])
+
+    def _shard(self, batches):
+        """
+        Batches of this rank, padded by repeating batches from the start (or
+        truncated if drop_last) to a multiple of num_replicas first
+        """
+        if self.num_replicas == 1 or not batches:
+            return batches
+        if self.drop_last:
+            num_batches = len(batches) // self.num_replicas * self.num_replicas
+        else:
+            num_batches = math.ceil(len(batches) / self.num_replicas) * \
+                self.num_replicas
+        batches = [batches[i % len(batches)] for i in range(num_batches)]
+        return batches[self.rank::self.num_replicas]
+
+    def set_epoch(self, epoch):
+        """
+        Rebuilds this epoch's batches from seed and epoch, so all ranks
+        shuffle identically (SequenceTrainer calls this every epoch)
+        """
+        self.generator = np.random.default_rng([self.seed, epoch])
+        self.batches = self._epoch_batches()
+
+    def _make_batches(self, order):
+        """
+        Sorts observations by length (stable, so order breaks ties) and cuts
+        the sorted list into batches
+        """
+        order = order[np.lexsort((self.max_tokens_per_day[order],
+                                  self.num_days[order]))]
+        if self.batch_size is not None:
+            batches = [order[i:i + self.batch_size]
+                       for i in range(0, len(order), self.batch_size)]
+            if self.drop_last and batches and \
+                    len(batches[-1]) < self.batch_size:
+                batches = batches[:-1]
+            return batches
+
+        if self.num_tokens is not None:
+            return self._make_token_batches(order)
+        batches, batch = [], []
+        max_days, max_tokens_per_day = 0, 0
+        for idx in order:
+            days = max(max_days, self.num_days[idx])
+            tokens = max(max_tokens_per_day, self.max_tokens_per_day[idx])
+            if batch and (len(batch) + 1) * days * tokens > self.max_tokens:
+                batches.append(np.array(batch))
+                batch = []
+                days = self.num_days[idx]
+                tokens = self.max_tokens_per_day[idx]
+            batch.append(idx)
+            max_days, max_tokens_per_day = days, tokens
+        if batch:
+            batches.append(np.array(batch))
+        return batches
+
+    def _make_token_batches(self, order):
+        """
+        Cuts sorted observations into batches of at most max_tokens real
+        tokens. An observation over the budget gets a batch of its own.
+        """
+        batches, batch = [], []
+        batch_tokens = 0
+        for idx in order:
+            if batch and batch_tokens + self.num_tokens[idx] > self.max_tokens:
+                batches.append(np.array(batch))
+                batch, batch_tokens = [], 0
+            batch.append(idx)
+            batch_tokens += self.num_tokens[idx]
+        if batch:
+            batches.append(np.array(batch))
+        return batches
+
+    @classmethod
+    def from_index(cls, df_index, flat=False, **kwargs):
+        """
+        Builds a sampler from load_sequence_index output. If flat, token
+        budgets count real tokens (flat_collate) instead of padded volume.
+        """
+        return cls(df_index.num_days.values,
+                   df_index.max_tokens_per_day.values,
+                   num_tokens=df_index.num_tokens.values if flat else None,
+                   **kwargs)
+
+    def __iter__(self):
+        batches = self.batches
+        if self.shuffle:
+            self.batches = self._epoch_batches()
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        """
+        Number of batches the next __iter__ yields
+        """
+        return len(self.batches)
@@ -12,5 +12,6 @@ from healthrex_ml.extractors.starr_extractors import (
     DummyExtractor,
     table_exists,
     add_create_or_append_logic,
+    bins_query,
     REPLACE_TABLE
 )
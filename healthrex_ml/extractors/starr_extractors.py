@@ -29,7 +29,8 @@ class FlowsheetBinsExtractor():
 
     def __init__(self, cohort_table_id, feature_table_id,
                  base_names=DEFAULT_FLOWSHEET_FEATURES, look_back_days=3, bins=5,
-                 project_id='som-nero-phi-jonc101', dataset='shc_core_2021'):
+                 project_id='som-nero-phi-jonc101', dataset='shc_core_2021',
+                 bin_lup=None):
         """
         Tokenizes flowsheets into bins and then writes or appends to temp
         dataset. 
@@ -40,6 +41,8 @@ class FlowsheetBinsExtractor():
                 descriptions
             project_id: name of project you are extracting data from
             dataset: name of dataset you are extracting data from
+            bin_lup: dataframe of saved bin thresholds (bin_lup.csv). If given
+                values are binned with these instead of cohort percentiles
         Returns:
             df_lup : dataframe with bin thresholds
         """
@@ -49,6 +52,7 @@ class FlowsheetBinsExtractor():
         self.look_back_days = look_back_days
         self.project_id = project_id
         self.dataset = dataset
+        self.bin_lup = bin_lup
         self.base_names = "("
         for i, flow in enumerate(base_names):
             if i == len(base_names) - 1:
@@ -89,31 +93,13 @@ class FlowsheetBinsExtractor():
             f.numerical_val_1 IS NOT NULL
         ),
 
-        ranked as (
-        SELECT DISTINCT
-            observation_id, index_time, feature_type,
-            feature_time, feature_id, feature,
-            PERCENT_RANK() OVER (PARTITION BY feature ORDER BY value) value
-        FROM 
-            flowsheet_vals
-        )
-
-        SELECT DISTINCT
-            observation_id, index_time, feature_type,
-            feature_time, feature_id,
-            CASE WHEN value < 0.2 THEN CONCAT(feature, '_0')
-                WHEN value < 0.4 THEN CONCAT(feature, '_1')
-                WHEN value < 0.6 THEN CONCAT(feature, '_2')
-                WHEN value < 0.8 THEN CONCAT(feature, '_3')
-                ELSE CONCAT(feature, '_4')
-            END feature,
-            1 value
-        FROM
-            ranked
+        {bins_query('flowsheet_vals', self.bin_lup)}
         """
         query = add_create_or_append_logic(query, self.feature_table_id)
         query_job = self.client.query(query)
         query_job.result()
+        if self.bin_lup is not None:
+            return None
         df_lup = self.get_bin_thresholds()
         return df_lup
 
@@ -166,13 +152,16 @@ class LabResultBinsExtractor():
 
     def __init__(self, cohort_table_id, feature_table_id,
                  base_names=DEFAULT_LAB_COMPONENT_IDS, bins=5, look_back_days=14,
-                 project_id='som-nero-phi-jonc101', dataset='shc_core_2021'):
+                 project_id='som-nero-phi-jonc101', dataset='shc_core_2021',
+                 bin_lup=None):
         """
         Args:
             cohort_table: name of cohort table -- used to join to features
             temp_dataset: name of temp dataset with cohort table
             project_id: name of project you are extracting data from
             dataset: name of dataset you are extracting data from
+            bin_lup: dataframe of saved bin thresholds (bin_lup.csv). If given
+                values are binned with these instead of cohort percentiles
         """
         self.cohort_table_id = cohort_table_id
         self.feature_table_id = feature_table_id
@@ -181,6 +170,7 @@ class LabResultBinsExtractor():
         self.look_back_days = look_back_days
         self.project_id = project_id
         self.dataset = dataset
+        self.bin_lup = bin_lup
         self.base_name_string = "("
         for i, base_name in enumerate(base_names):
             if i == len(base_names) - 1:
@@ -221,31 +211,13 @@ class LabResultBinsExtractor():
             lr.ord_num_value IS NOT NULL
         ),
 
-        ranked as (
-        SELECT DISTINCT
-            observation_id, index_time, feature_type,
-            feature_time, feature_id, feature,
-            PERCENT_RANK() OVER (PARTITION BY feature ORDER BY value) value
-        FROM 
-            labresults_values
-        )
-
-        SELECT DISTINCT
-            observation_id, index_time, feature_type,
-            feature_time, feature_id,
-            CASE WHEN value < 0.2 THEN CONCAT(feature, '_0')
-                WHEN value < 0.4 THEN CONCAT(feature, '_1')
-                WHEN value < 0.6 THEN CONCAT(feature, '_2')
-                WHEN value < 0.8 THEN CONCAT(feature, '_3')
-                ELSE CONCAT(feature, '_4')
-            END feature,
-            1 value
-        FROM
-            ranked
+        {bins_query('labresults_values', self.bin_lup)}
         """
         query = add_create_or_append_logic(query, self.feature_table_id)
         query_job = self.client.query(query)
         query_job.result()
+        if self.bin_lup is not None:
+            return None
         df_lup = self.get_bin_thresholds()
         return df_lup
 
@@ -641,12 +613,15 @@ class AgeExtractor():
     """
 
     def __init__(self, cohort_table_id, feature_table_id, bins=5,
-                 project_id='som-nero-phi-jonc101', dataset='shc_core_2021'):
+                 project_id='som-nero-phi-jonc101', dataset='shc_core_2021',
+                 bin_lup=None):
         """
         Args:
             cohort_table: name of cohort table -- used to join to features
             project_id: name of project you are extracting data from
             dataset: name of dataset you are extracting data from
+            bin_lup: dataframe of saved bin thresholds (bin_lup.csv). If given
+                values are binned with these instead of cohort percentiles
         """
         self.cohort_table_id = cohort_table_id
         self.feature_table_id = feature_table_id
@@ -654,6 +629,7 @@ class AgeExtractor():
         self.num_bins = bins
         self.project_id = project_id
         self.dataset = dataset
+        self.bin_lup = bin_lup
 
     def __call__(self):
         """
@@ -679,31 +655,13 @@ class AgeExtractor():
         ON
             labels.anon_id = demo.ANON_ID
         ),
-        ranked as (
-        SELECT DISTINCT
-            observation_id, index_time, feature_type,
-            feature_time, feature_id, feature,
-            PERCENT_RANK() OVER (PARTITION BY feature ORDER BY value) value
-        FROM
-            age_values
-        )
-
-        SELECT DISTINCT
-            observation_id, index_time, feature_type,
-            feature_time, feature_id,
-            CASE WHEN value < 0.2 THEN CONCAT(feature, '_0')
-                WHEN value < 0.4 THEN CONCAT(feature, '_1')
-                WHEN value < 0.6 THEN CONCAT(feature, '_2')
-                WHEN value < 0.8 THEN CONCAT(feature, '_3')
-                ELSE CONCAT(feature, '_4')
-            END feature,
-            1 value
-        FROM
-            ranked
+        {bins_query('age_values', self.bin_lup)}
         """
         query = add_create_or_append_logic(query, self.feature_table_id)
         query_job = self.client.query(query)
         query_job.result()
+        if self.bin_lup is not None:
+            return None
         df_lup = self.get_bin_thresholds()
         return df_lup
 
@@ -781,6 +739,76 @@ class DummyExtractor():
         query_job = self.client.query(query)
         query_job.result()
 
+def bins_query(values_table, bin_lup=None):
+    """
+    SQL that tokenizes numerical values in values_table into five bins named
+    feature_0 to feature_4. By default bins are percentiles of the cohort. If
+    bin_lup (saved bin thresholds) is given values are binned against those so
+    a new cohort is tokenized exactly like the training cohort.
+    """
+    if bin_lup is None:
+        return f"""ranked as (
+        SELECT DISTINCT
+            observation_id, index_time, feature_type,
+            feature_time, feature_id, feature,
+            PERCENT_RANK() OVER (PARTITION BY feature ORDER BY value) value
+        FROM 
+            {values_table}
+        )
+
+        SELECT DISTINCT
+            observation_id, index_time, feature_type,
+            feature_time, feature_id,
+            CASE WHEN value < 0.2 THEN CONCAT(feature, '_0')
+                WHEN value < 0.4 THEN CONCAT(feature, '_1')
+                WHEN value < 0.6 THEN CONCAT(feature, '_2')
+                WHEN value < 0.8 THEN CONCAT(feature, '_3')
+                ELSE CONCAT(feature, '_4')
+            END feature,
+            1 value
+        FROM
+            ranked"""
+
+    rows = []
+    for _, row in bin_lup.iterrows():
+        feature = str(row['feature']).replace("'", "\\'")
+        mins = [row[f'min_bin_{i}'] for i in range(1, 5)]
+        mins = ['NULL' if pd.isnull(m) or m == '' else m for m in mins]
+        rows.append(
+            f"SELECT '{feature}' feature, "
+            f"CAST({mins[0]} AS FLOAT64) min_bin_1, "
+            f"CAST({mins[1]} AS FLOAT64) min_bin_2, "
+            f"CAST({mins[2]} AS FLOAT64) min_bin_3, "
+            f"CAST({mins[3]} AS FLOAT64) min_bin_4")
+    if not rows:
+        rows.append("SELECT CAST(NULL AS STRING) feature, "
+                    "CAST(NULL AS FLOAT64) min_bin_1, "
+                    "CAST(NULL AS FLOAT64) min_bin_2, "
+                    "CAST(NULL AS FLOAT64) min_bin_3, "
+                    "CAST(NULL AS FLOAT64) min_bin_4")
+    thresholds = '\n            UNION ALL '.join(rows)
+    return f"""thresholds as (
+            {thresholds}
+        )
+
+        SELECT DISTINCT
+            v.observation_id, v.index_time, v.feature_type,
+            v.feature_time, v.feature_id,
+            CASE WHEN v.value < t.min_bin_1 THEN CONCAT(v.feature, '_0')
+                WHEN v.value < t.min_bin_2 THEN CONCAT(v.feature, '_1')
+                WHEN v.value < t.min_bin_3 THEN CONCAT(v.feature, '_2')
+                WHEN v.value < t.min_bin_4 THEN CONCAT(v.feature, '_3')
+                ELSE CONCAT(v.feature, '_4')
+            END feature,
+            1 value
+        FROM
+            {values_table} v
+        INNER JOIN
+            thresholds t
+        ON
+            v.feature = t.feature"""
+
+
 def table_exists(feature_table_id):
     """
     Check if table exists
@@ -6,7 +6,8 @@ from healthrex_ml.featurizers.constants import (
 
 from healthrex_ml.featurizers.starr_featurizers import (
     SequenceFeaturizer,
-    BagOfWordsFeaturizer
+    BagOfWordsFeaturizer,
+    BagOfWordsAndSequenceFeaturizer
 )
 
 from healthrex_ml.extractors.starr_extractors import *
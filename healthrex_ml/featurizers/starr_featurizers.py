@@ -1,8 +1,11 @@
 """
 Definition of BagOfWordsFeaturizer
 Definition of SequenceFeaturizer
+Definition of BagOfWordsAndSequenceFeaturizer
 TODO: Definition of SummaryStatFeaturizer
 """
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import json
 import os
 from re import S
@@ -14,16 +17,48 @@ from tqdm import tqdm
 import torch
 from torch.nn.utils.rnn import pad_sequence
 from scipy.sparse import csr_matrix
-from scipy.sparse import save_npz
+from sklearn.decomposition import TruncatedSVD
 from sklearn.feature_extraction.text import TfidfTransformer
 
 from healthrex_ml import extractors
+from healthrex_ml.datasets.artifacts import as_float32_csr
+from healthrex_ml.datasets.artifacts import load_table
+from healthrex_ml.datasets.artifacts import save_csr
+from healthrex_ml.datasets.artifacts import save_table
+from healthrex_ml.datasets.starr_datasets import save_sequence_index
+from healthrex_ml.datasets.starr_datasets import sequence_index_row
 from healthrex_ml.featurizers import DEFAULT_DEPLOY_CONFIG
 from healthrex_ml.featurizers import DEFAULT_LAB_COMPONENT_IDS
 from healthrex_ml.featurizers import DEFAULT_FLOWSHEET_FEATURES
+from healthrex_ml.featurizers.vocabulary import OOV_SUFFIX
+from healthrex_ml.featurizers.vocabulary import build_vocabulary
+from healthrex_ml.featurizers.vocabulary import lookup_term
 
 import pdb
 
+
+def download_queries(queries):
+    """
+    Runs a dict of name to query against bigquery in parallel and returns a
+    dict of name to dataframe
+    """
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = {name: executor.submit(pd.read_gbq, query)
+                   for name, query in queries.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def load_bin_lup(outpath):
+    """
+    Reads bin thresholds saved by a featurizer. Returns an empty table if the
+    featurizer had no binned features, so extractors never refit bins.
+    """
+    bin_lup_path = os.path.join(outpath, 'bin_lup.csv')
+    if os.path.exists(bin_lup_path):
+        return pd.read_csv(bin_lup_path, na_filter=False)
+    return pd.DataFrame(columns=['feature', 'min_bin_1', 'min_bin_2',
+                                 'min_bin_3', 'min_bin_4'])
+
 class SequenceFeaturizer():
     """
     Uses FeatureExtractors to generate a set of variable lengh sequences
@@ -40,7 +75,10 @@ class SequenceFeaturizer():
     def __init__(self, cohort_table_id, feature_table_id, train_years,
                  val_years, test_years, label_columns, outpath='./features',
                  project='som-nero-phi-jonc101', dataset='shc_core_2021',
-                 feature_config=None):
+                 feature_config=None, integer_tokens=False, min_df=1,
+                 max_df=1.0, max_features=None, from_table=False,
+                 vocabulary=None, max_days=None, max_tokens_per_day=None,
+                 feature_type_priority=None, coalesce_old_days=False):
         """
         Args:
             cohort_table_id: ex 'mining-clinical-decisions.conor_db.table_name'
@@ -55,6 +93,30 @@ class SequenceFeaturizer():
             dataset: bq dataset with project to extract data from
             feature_config: dictionary with feature types, bins and look back
                 windows.
+            integer_tokens: if true vocabulary ids are assigned from the
+                training split in bigquery and each day is downloaded as an
+                array of integer token ids instead of a '---' joined string
+            min_df: terms found in fewer training observations are collapsed
+                into a per feature_type out of vocabulary bucket. int is a
+                count, float a proportion of training observations
+            max_df: terms found in more training observations are collapsed
+                into the out of vocabulary bucket (int or float as min_df)
+            max_features: if not None keep only this many of the most frequent
+                training terms
+            from_table: default False. If true no feature extraction occurs,
+                sequences are created from the existing feature table
+            vocabulary: optional dict of feature to token id (0 reserved for
+                padding) used instead of building one from the training split
+            max_days: if not None keep only this many most recent days of
+                each sequence when saving
+            max_tokens_per_day: if not None keep at most this many tokens per
+                day, chosen by feature_type_priority
+            feature_type_priority: list of feature types (extractor names)
+                in the order their tokens are kept when a day is capped.
+                Unlisted types follow in name order, ties keep feature order.
+            coalesce_old_days: if true days beyond max_days are merged into
+                one summary bag of their distinct tokens placed first, so the
+                sequence holds max_days - 1 recent days plus the summary
         """
         self.cohort_table_id = cohort_table_id
         self.feature_table_id = feature_table_id
@@ -70,14 +132,40 @@ class SequenceFeaturizer():
         self.val_years = [int(y) for y in val_years]
         self.test_years = [int(y) for y in test_years]
         self.label_columns = label_columns
+        self.integer_tokens = integer_tokens
+        self.min_df = min_df
+        self.max_df = max_df
+        self.max_features = max_features
+        self.from_table = from_table
+        self.vocabulary = vocabulary
+        self.max_days = max_days
+        self.max_tokens_per_day = max_tokens_per_day
+        self.feature_type_priority = feature_type_priority or []
+        self.coalesce_old_days = coalesce_old_days
+        self.oov_buckets = {}
 
     def __call__(self):
         """
         Generates sequence feature vectors and saves to outpath
         """
         label_cols = ', '.join([f"c.{l}" for l in self.label_columns])
-        self.construct_feature_timeline()
-        self.collapse_timeline_to_days()
+        if not self.from_table:
+            self.construct_feature_timeline()
+        elif not hasattr(self, 'lups'):
+            self.lups = []
+        if self.vocabulary is not None:
+            vocab_map = self.vocabulary
+            self.oov_buckets = {term[:-len(OOV_SUFFIX)]: index
+                                for term, index in vocab_map.items()
+                                if term.endswith(OOV_SUFFIX)}
+        if self.integer_tokens:
+            if self.vocabulary is None:
+                vocab_map = self.construct_vocab_table()
+            else:
+                self.upload_vocab_tables(vocab_map)
+            self.collapse_timeline_to_token_ids()
+        else:
+            self.collapse_timeline_to_days()
         query = f"""
         SELECT
             f.*, {label_cols}, index_time
@@ -96,17 +184,12 @@ class SequenceFeaturizer():
         # Split into train, val and test and ensure only terms in train are used
         train_seqs = df[df['index_time'].dt.year.isin(self.train_years)]
 
-        # Build vocab dict and save
-        vocab = []
-        for feature_list in train_seqs.feature.values:
-            if feature_list is not None:
-                vocab += [v for v in feature_list.split('---')]
-        vocab = set(vocab)
-        vocab_map = {}
-        counter = 1  # reserve 0 for padding
-        for term in vocab:
-            vocab_map[term] = counter
-            counter += 1
+        # Build vocab dict (reserve 0 for padding) and save
+        if not self.integer_tokens and self.vocabulary is None:
+            term_stats, num_docs = self._term_stats(train_seqs)
+            vocab_map, self.oov_buckets = build_vocabulary(
+                term_stats, num_docs, min_df=self.min_df, max_df=self.max_df,
+                max_features=self.max_features, start=1)
 
         val_seqs = df[df['index_time'].dt.year.isin(self.val_years)]
         test_seqs = df[df['index_time'].dt.year.isin(self.test_years)]
@@ -114,17 +197,10 @@ class SequenceFeaturizer():
 
         # Create working directory if does not already exist and save features
         for dataset, seqs in seq_dict.items():
-            os.makedirs(os.path.join(self.outpath, dataset), exist_ok=True)
             print(f"Generating {dataset} sequences")
-            for obs in tqdm(seqs.observation_id.unique()):
-                example = seqs[seqs['observation_id'] == obs]
-                sequence = self.pad_examples(example, vocab_map)
-                time_deltas = example.time_deltas.values
-                labels = example[self.label_columns].values
-                out_file = os.path.join(self.outpath, dataset, f"{obs}.pt")
-                torch.save({"sequence": sequence,
-                            "time_deltas": time_deltas,
-                            "labels": labels}, out_file)
+            self.save_sequences(seqs, vocab_map,
+                                os.path.join(self.outpath, dataset),
+                                self.label_columns)
 
         # Save feature vocab
         with open(os.path.join(self.outpath, 'feature_vocab.npz'), 'w') as fp:
@@ -143,16 +219,286 @@ class SequenceFeaturizer():
         with open(os.path.join(self.outpath, 'feature_config.json'), 'w') as f:
             json.dump(self.feature_config, f)
 
-    def pad_examples(self, example, vocab):
+    def transform(self, cohort_table_id, feature_table_id=None, outpath=None):
+        """
+        Featurizes a new cohort against the vocab and bin thresholds saved in
+        outpath by a previous call, without recomputing either. Sequences are
+        saved to a single directory. Label columns are saved if the new cohort
+        has them.
+        Args:
+            cohort_table_id: cohort table of the new observations
+            feature_table_id: long form feature table for the new cohort,
+                default {feature_table_id}_transform
+            outpath: directory to save sequences, default {outpath}/transform
+        """
+        if feature_table_id is None:
+            feature_table_id = f"{self.feature_table_id}_transform"
+        if outpath is None:
+            outpath = os.path.join(self.outpath, 'transform')
+        with open(os.path.join(self.outpath, 'feature_vocab.npz'), 'r') as f:
+            vocab_map = json.load(f)
+        bin_lup = load_bin_lup(self.outpath)
+
+        featurizer = copy.copy(self)
+        featurizer.cohort_table_id = cohort_table_id
+        featurizer.feature_table_id = feature_table_id
+        featurizer.oov_buckets = {term[:-len(OOV_SUFFIX)]: index
+                                  for term, index in vocab_map.items()
+                                  if term.endswith(OOV_SUFFIX)}
+        extractors.starr_extractors.REPLACE_TABLE = True
+        featurizer.construct_feature_timeline(bin_lup=bin_lup)
+        if self.integer_tokens:
+            featurizer.upload_vocab_tables(vocab_map)
+            featurizer.collapse_timeline_to_token_ids()
+        else:
+            featurizer.collapse_timeline_to_days()
+
+        cohort_columns = [field.name for field in
+                          self.client.get_table(cohort_table_id).schema]
+        label_columns = [l for l in self.label_columns if l in cohort_columns]
+        label_cols = ''.join([f"c.{l}, " for l in label_columns])
+        query = f"""
+        SELECT
+            f.*, {label_cols}index_time
+        FROM
+            {feature_table_id}_days f
+        INNER JOIN
+            {cohort_table_id} c
+        USING
+            (observation_id)
+        ORDER BY
+            observation_id, time_deltas
+        DESC
+        """
+        df = pd.read_gbq(query, progress_bar_type='tqdm')
+        featurizer.save_sequences(df, vocab_map, outpath, label_columns)
+
+    def save_sequences(self, seqs, vocab_map, out_dir, label_columns):
+        """
+        Saves one {observation_id}.pt file per observation in seqs to out_dir
+        along with an index.csv of sequence lengths used by batch samplers
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        index = []
+        for obs, example in tqdm(seqs.groupby('observation_id', sort=False)):
+            days = self.bound_days(self.day_tokens(example, vocab_map))
+            if not days:
+                continue
+            sequence = self.pad_examples(days)
+            time_deltas = np.array([day[2] for day in days])
+            # Label columns are constant within an observation
+            labels = example[label_columns].values[:len(days)]
+            out_file = os.path.join(out_dir, f"{obs}.pt")
+            torch.save({"sequence": sequence,
+                        "time_deltas": time_deltas,
+                        "labels": labels}, out_file)
+            index.append(sequence_index_row(f"{obs}.pt", sequence))
+        save_sequence_index(index, out_dir)
+
+    def day_tokens(self, example, vocab):
         """
-        Pads days within an example with zeros so all same length. 
+        List of (token ids, feature types, time delta) for each day of an
+        example, oldest day first. When integer_tokens is set days already
+        hold token ids and vocab is unused.
         """
-        sequences = [torch.tensor(
-                    [vocab[a] for a in e.split('---') if a in vocab])
-            for e in example.feature.values if e is not None]
+        days = []
+        for e, t, d in zip(example.feature.values,
+                           example.feature_types.values,
+                           example.time_deltas.values):
+            if e is None:
+                continue
+            if self.integer_tokens:
+                days.append((list(e), list(t), d))
+                continue
+            tokens, types = [], []
+            for a, b in zip(e.split('---'), t.split('---')):
+                index = lookup_term(a, b, vocab, self.oov_buckets)
+                if index is not None:
+                    tokens.append(index)
+                    types.append(b)
+            days.append((tokens, types, d))
+        return days
+
+    def bound_days(self, days):
+        """
+        Applies max_days (optionally coalescing older days into a summary
+        bag) and max_tokens_per_day to the output of day_tokens
+        """
+        if self.max_days is not None and len(days) > self.max_days:
+            if self.coalesce_old_days:
+                old_days = days[:len(days) - (self.max_days - 1)]
+                tokens, types, seen = [], [], set()
+                for day_tokens, day_types, _ in old_days:
+                    for a, b in zip(day_tokens, day_types):
+                        if a not in seen:
+                            seen.add(a)
+                            tokens.append(a)
+                            types.append(b)
+                # Summary bag takes the time delta of the latest merged day
+                summary = (tokens, types, old_days[-1][2])
+                days = [summary] + days[len(old_days):]
+            else:
+                days = days[len(days) - self.max_days:]
+        if self.max_tokens_per_day is not None:
+            days = [self.cap_day(*day) for day in days]
+        return days
+
+    def cap_day(self, tokens, types, time_delta):
+        """
+        Keeps the max_tokens_per_day highest priority tokens of a day, in
+        their original order
+        """
+        if len(tokens) <= self.max_tokens_per_day:
+            return tokens, types, time_delta
+        rank = {t: i for i, t in enumerate(self.feature_type_priority)}
+        keep = sorted(range(len(tokens)),
+                      key=lambda i: (rank.get(types[i], len(rank)),
+                                     types[i], i))
+        keep = sorted(keep[:self.max_tokens_per_day])
+        return ([tokens[i] for i in keep], [types[i] for i in keep],
+                time_delta)
+
+    def pad_examples(self, days):
+        """
+        Pads days within an example with zeros so all same length
+        """
+        sequences = [torch.tensor(tokens, dtype=torch.long)
+                     for tokens, _, _ in days]
         sequences_padded = pad_sequence(sequences, batch_first=True)
         return sequences_padded
 
+    def _term_stats(self, seqs):
+        """
+        Counts the number of observations each term appears in from the
+        '---' joined day strings. Returns term stats and number of observations
+        """
+        doc_terms = {}
+        for obs, e, t in zip(seqs.observation_id.values, seqs.feature.values,
+                             seqs.feature_types.values):
+            if e is None:
+                continue
+            terms = doc_terms.setdefault(obs, {})
+            for a, b in zip(e.split('---'), t.split('---')):
+                terms.setdefault(a, b)
+        df_counts, feature_types = {}, {}
+        for terms in doc_terms.values():
+            for a, b in terms.items():
+                df_counts[a] = df_counts.get(a, 0) + 1
+                feature_types.setdefault(a, b)
+        features = sorted(df_counts)
+        term_stats = pd.DataFrame(data={
+            'feature': features,
+            'feature_type': [feature_types[a] for a in features],
+            'df': [df_counts[a] for a in features]
+        })
+        return term_stats, len(doc_terms)
+
+    def construct_vocab_table(self):
+        """
+        Assigns an integer token id to every feature kept from the training
+        split and stores the mapping in bigquery as {feature_table_id}_vocab,
+        with out of vocabulary buckets in {feature_table_id}_vocab_oov. Id 0 is
+        reserved for padding. Returns the vocab dict.
+        """
+        train_years = ', '.join([str(y) for y in self.train_years])
+        query = f"""
+        SELECT
+            f.feature,
+            ANY_VALUE(f.feature_type) feature_type,
+            COUNT(DISTINCT f.observation_id) df
+        FROM
+            {self.feature_table_id} f
+        INNER JOIN
+            {self.cohort_table_id} c
+        USING
+            (observation_id)
+        WHERE
+            EXTRACT(YEAR FROM c.index_time) IN ({train_years})
+        AND
+            f.feature IS NOT NULL
+        GROUP BY
+            f.feature
+        ORDER BY
+            f.feature
+        """
+        term_stats = pd.read_gbq(query)
+        query = f"""
+        SELECT
+            COUNT(DISTINCT f.observation_id) num_docs
+        FROM
+            {self.feature_table_id} f
+        INNER JOIN
+            {self.cohort_table_id} c
+        USING
+            (observation_id)
+        WHERE
+            EXTRACT(YEAR FROM c.index_time) IN ({train_years})
+        """
+        num_docs = int(pd.read_gbq(query).num_docs.values[0])
+        vocab_map, self.oov_buckets = build_vocabulary(
+            term_stats, num_docs, min_df=self.min_df, max_df=self.max_df,
+            max_features=self.max_features, start=1)
+        self.upload_vocab_tables(vocab_map)
+        return vocab_map
+
+    def upload_vocab_tables(self, vocab_map):
+        """
+        Writes vocab_map and self.oov_buckets to the bigquery tables joined by
+        collapse_timeline_to_token_ids
+        """
+        oov_terms = set(self.oov_buckets.values())
+        df_vocab = pd.DataFrame(data={
+            'feature': [t for t in vocab_map if vocab_map[t] not in oov_terms],
+            'token_id': [i for i in vocab_map.values() if i not in oov_terms]
+        })
+        df_oov = pd.DataFrame(data={
+            'feature_type': list(self.oov_buckets.keys()),
+            'token_id': list(self.oov_buckets.values())
+        })
+        job_config = bigquery.LoadJobConfig(write_disposition='WRITE_TRUNCATE')
+        for table_id, df_table in [(f"{self.feature_table_id}_vocab", df_vocab),
+                                   (f"{self.feature_table_id}_vocab_oov",
+                                    df_oov)]:
+            load_job = self.client.load_table_from_dataframe(
+                df_table, table_id, job_config=job_config)
+            load_job.result()
+
+    def collapse_timeline_to_token_ids(self):
+        """
+        Groups long form feature vector by day and collects the token ids of
+        all in vocabulary features, with their feature types in a parallel
+        array. Features not in the training vocab fall back to the bucket of
+        their feature_type, or are dropped if it has none.
+        """
+        query = f"""
+        CREATE OR REPLACE TABLE {self.feature_table_id}_days AS (
+        SELECT
+            f.observation_id,
+            ARRAY_AGG(COALESCE(v.token_id, o.token_id)
+                      ORDER BY f.feature) feature,
+            ARRAY_AGG(f.feature_type ORDER BY f.feature) feature_types,
+            TIMESTAMP_DIFF(f.index_time, f.feature_time, DAY) time_deltas
+        FROM
+            {self.feature_table_id} f
+        LEFT JOIN
+            {self.feature_table_id}_vocab v
+        ON
+            f.feature = v.feature
+        LEFT JOIN
+            {self.feature_table_id}_vocab_oov o
+        ON
+            f.feature_type = o.feature_type
+        WHERE
+            f.feature IS NOT NULL
+        AND
+            COALESCE(v.token_id, o.token_id) IS NOT NULL
+        GROUP BY
+            observation_id, time_deltas
+        )
+        """
+        query_job = self.client.query(query)
+        query_job.result()
+
     def collapse_timeline_to_days(self):
         """
         Groups long form feature vector by day and collapses all feature values
@@ -161,10 +507,15 @@ class SequenceFeaturizer():
         CREATE OR REPLACE TABLE {self.feature_table_id}_days AS (
         SELECT 
             observation_id,
-            STRING_AGG(feature, '---') feature,
+            STRING_AGG(feature, '---' ORDER BY feature) feature,
+            STRING_AGG(feature_type, '---' ORDER BY feature) feature_types,
             TIMESTAMP_DIFF(index_time, feature_time, DAY) time_deltas
         FROM 
             {self.feature_table_id}
+        WHERE
+            feature IS NOT NULL
+        AND
+            feature_type IS NOT NULL
         GROUP BY
             observation_id, time_deltas
         )
@@ -172,14 +523,15 @@ class SequenceFeaturizer():
         query_job = self.client.query(query)
         query_job.result()
 
-    def construct_feature_timeline(self):
+    def construct_feature_timeline(self, bin_lup=None):
         """
         Executes all logic to iteratively append rows to the biq query long form
         feature matrix destination table.  Does this by iteratively joining
         cohort table to tables with desired features, filtering for events
         that occur within each look up range, and then transforming into bag of
         words style representations.  Features with numerical values are binned
-        into buckets to enable bag of words repsesentation. 
+        into buckets to enable bag of words repsesentation. If bin_lup is given
+        numerical features are binned with those saved thresholds.
         """
         fextractors = []
         # Get categorical features
@@ -212,7 +564,8 @@ class SequenceFeaturizer():
             ae = extractors.AgeExtractor(
                 self.cohort_table_id,
                 self.feature_table_id,
-                bins=self.feature_config['Numerical']['Age'][0]['num_bins'])
+                bins=self.feature_config['Numerical']['Age'][0]['num_bins'],
+                bin_lup=bin_lup)
             fextractors.append(ae)
         if 'LabResults' in self.feature_config['Numerical']:
             lre = extractors.LabResultBinsExtractor(
@@ -220,14 +573,16 @@ class SequenceFeaturizer():
                 self.feature_table_id,
                 base_names=DEFAULT_LAB_COMPONENT_IDS,
                 bins=self.feature_config['Numerical']
-                ['LabResults'][0]['num_bins'])
+                ['LabResults'][0]['num_bins'],
+                bin_lup=bin_lup)
             fextractors.append(lre)
         if 'Vitals' in self.feature_config['Numerical']:
             fbe = extractors.FlowsheetBinsExtractor(
                 self.cohort_table_id,
                 self.feature_table_id,
                 flowsheet_descriptions=DEFAULT_FLOWSHEET_FEATURES,
-                bins=self.feature_config['Numerical']['Vitals'][0]['num_bins'])
+                bins=self.feature_config['Numerical']['Vitals'][0]['num_bins'],
+                bin_lup=bin_lup)
             fextractors.append(fbe)
 
         # Call extractors and collect any look up tables
@@ -245,7 +600,9 @@ class BagOfWordsFeaturizer():
     def __init__(self, cohort_table_id, feature_table_id, extractors,
                  train_years=None, test_years=None, outpath='./features',
                  project='som-nero-phi-jonc101', dataset='shc_core_2021',
-                 feature_config=None, tfidf=True, from_table=False):
+                 feature_config=None, tfidf=True, from_table=False, min_df=1,
+                 max_df=1.0, max_features=None, svd_components=None,
+                 horizons=None, artifact_format='npz', fit_years=None):
         """
         Args:
             cohort_table_id: ex 'mining-clinical-decisions.conor_db.table_name'
@@ -265,6 +622,27 @@ class BagOfWordsFeaturizer():
             from_table: default False. If true no feature extraction occurs, 
                 sparse matrices created with feature types specified by list of
                 extractors 
+            min_df: terms found in fewer training observations are collapsed
+                into a per feature_type out of vocabulary column. int is a
+                count, float a proportion of training observations
+            max_df: terms found in more training observations are collapsed
+                into the out of vocabulary column (int or float as min_df)
+            max_features: if not None keep only this many of the most frequent
+                training terms as columns
+            svd_components: if not None fit a randomized truncated SVD with
+                this many components on the (tfidf) train matrix and also save
+                dense float32 train_features_svd.npy and test_features_svd.npy
+            horizons: optional ordered dict of horizon name to hours before
+                index_time, ex {'24h': 24, '7d': 168, '28d': 672, 'ever': None}.
+                Each event is counted in the first horizon it falls within
+                (None means no limit) giving columns like 'feature@7d', stacked
+                by horizon. Computed in the same GROUP BY as plain counts.
+            artifact_format: 'npz' saves compressed npz matrices and csv
+                labels and feature order. 'npy' saves raw memory mappable csr
+                arrays and parquet tables, see healthrex_ml.datasets.artifacts
+            fit_years: if not None, vocabulary, tfidf and svd are fit only on
+                train rows from these years (ex excluding validation years
+                kept in the train matrix), default all of train_years
         """
         self.cohort_table_id = cohort_table_id
         self.feature_table_id = feature_table_id
@@ -274,6 +652,13 @@ class BagOfWordsFeaturizer():
         self.dataset = dataset
         self.tfidf = tfidf
         self.from_table = from_table
+        self.min_df = min_df
+        self.max_df = max_df
+        self.max_features = max_features
+        self.svd_components = svd_components
+        self.horizons = horizons
+        self.artifact_format = artifact_format
+        self.fit_years = fit_years
         if feature_config is None:
             self.feature_config = DEFAULT_DEPLOY_CONFIG
         else:
@@ -305,81 +690,95 @@ class BagOfWordsFeaturizer():
         if not self.from_table:
             self.construct_feature_timeline()
             self.construct_bag_of_words_rep()
-        else:
+        elif not hasattr(self, 'lups'):
             self.lups = []
-        feature_types = [f"'{ext.__class__.__name__}'" for ext in self.extractors]
-        query = f"""
-        SELECT
-            *
-        FROM
-            {self.feature_table_id}_bow
-        WHERE
-            feature_type in ({','.join(feature_types)})
-        ORDER BY
-            observation_id
-        """
-        df = pd.read_gbq(query, progress_bar_type='tqdm')
-        train_features = df[df['index_time'].dt.year.isin(self.train_years)]
-        apply_features = df[~df['index_time'].dt.year.isin(self.train_years)]
-        train_csr, train_ids, train_vocab = self.construct_sparse_matrix(
-            train_features, train_features)
-        test_csr, test_ids, test_vocab = self.construct_sparse_matrix(
-            train_features, apply_features)
+        # Download train and test features and labels in parallel, filtering
+        # splits in the warehouse
+        train_years = ', '.join([str(int(y)) for y in self.train_years])
+        queries = {
+            'train_features': self._features_query(
+                self.feature_table_id, f"IN ({train_years})"),
+            'test_features': self._features_query(
+                self.feature_table_id, f"NOT IN ({train_years})"),
+            'train_labels': self._labels_query(
+                self.cohort_table_id, f"IN ({train_years})"),
+            'test_labels': self._labels_query(
+                self.cohort_table_id, f"NOT IN ({train_years})")
+        }
+        dfs = download_queries(queries)
+        train_features = dfs['train_features']
+        apply_features = dfs['test_features']
+
+        # Feature rows are aligned to label rows through observation_id
+        train_labels = (dfs['train_labels']
+                        .sort_values('observation_id')
+                        .reset_index(drop=True))
+        test_labels = (dfs['test_labels']
+                       .sort_values('observation_id')
+                       .reset_index(drop=True))
+        # Vocabulary and transforms are fit on fit_years rows only
+        fit_rows = np.arange(len(train_labels))
+        fit_features = train_features
+        if self.fit_years is not None:
+            fit_years = [int(y) for y in self.fit_years]
+            in_fit = pd.to_datetime(train_labels.index_time).dt.year.isin(
+                fit_years).values
+            fit_rows = np.flatnonzero(in_fit)
+            fit_features = train_features[train_features.observation_id.isin(
+                train_labels.observation_id.values[fit_rows])]
+        train_csr, train_vocab = self.construct_sparse_matrix(
+            fit_features, train_features, train_labels.observation_id.values)
+        test_csr, test_vocab = self.construct_sparse_matrix(
+            fit_features, apply_features, test_labels.observation_id.values)
 
         # Apply tfidf transform if indicated and save
         if self.tfidf:
             transform = TfidfTransformer()
-            train_csr = transform.fit_transform(train_csr)
-            test_csr = transform.transform(test_csr)
+            transform.fit(train_csr[fit_rows])
+            train_csr = as_float32_csr(transform.transform(train_csr))
+            test_csr = as_float32_csr(transform.transform(test_csr))
             os.makedirs(self.outpath, exist_ok=True)
             transform_path = os.path.join(
                 self.outpath, 'tfidf_transform.pkl')
             with open(transform_path, 'wb') as w:
                 pickle.dump(transform, w)
 
-        # Query cohort table for labels
-        q_cohort = f"""
-            SELECT
-                *
-            FROM
-               {self.cohort_table_id}
-            ORDER BY
-                observation_id
-        """
-        df_cohort = pd.read_gbq(q_cohort, progress_bar_type='tqdm')
-        train_labels = df_cohort[df_cohort['index_time'].dt.year.isin(
-            self.train_years)]
-        test_labels = df_cohort[~df_cohort['index_time'].dt.year.isin(
-            self.train_years)]
-
-        # Sanity check - make sure ids from labels and features in same order
-        for a, b in zip(train_labels['observation_id'].values, train_ids):
-            try:
-                assert a == b
-            except:
-                pdb.set_trace()
-        for a, b in zip(test_labels['observation_id'].values, test_ids):
-            assert a == b
+        # Compress into dense svd components if indicated and save
+        if self.svd_components is not None:
+            svd = TruncatedSVD(n_components=self.svd_components,
+                               algorithm='randomized', random_state=0)
+            svd.fit(train_csr[fit_rows])
+            train_svd = svd.transform(train_csr).astype(np.float32)
+            test_svd = svd.transform(test_csr).astype(np.float32)
+            os.makedirs(self.outpath, exist_ok=True)
+            np.save(os.path.join(self.outpath, 'train_features_svd.npy'),
+                    train_svd)
+            np.save(os.path.join(self.outpath, 'test_features_svd.npy'),
+                    test_svd)
+            with open(os.path.join(self.outpath, 'svd_transform.pkl'),
+                      'wb') as w:
+                pickle.dump(svd, w)
 
         # Create working directory if does not already exist and save features
         os.makedirs(self.outpath, exist_ok=True)
-        save_npz(os.path.join(self.outpath, 'train_features.npz'), train_csr)
-        save_npz(os.path.join(self.outpath, 'test_features.npz'), test_csr)
+        save_csr(train_csr, self.outpath, 'train_features',
+                 self.artifact_format)
+        save_csr(test_csr, self.outpath, 'test_features', self.artifact_format)
         print(f"Feature matrix generated with {train_csr.shape[1]} features")
 
         # Save labels
-        train_labels.to_csv(os.path.join(self.outpath, 'train_labels.csv'),
-                            index=None)
-        test_labels.to_csv(os.path.join(self.outpath, 'test_labels.csv'),
-                           index=None)
+        save_table(train_labels, self.outpath, 'train_labels',
+                   self.artifact_format)
+        save_table(test_labels, self.outpath, 'test_labels',
+                   self.artifact_format)
 
         # Save feature order
         df_vocab = pd.DataFrame(data={
             'features': [t for t in train_vocab],
             'indices': [train_vocab[t] for t in train_vocab]
         })
-        df_vocab.to_csv(os.path.join(self.outpath, 'feature_order.csv'),
-                        index=None)
+        save_table(df_vocab, self.outpath, 'feature_order',
+                   self.artifact_format)
 
         # Save bin thresholds if they exist
         self.df_lup = pd.DataFrame()
@@ -394,6 +793,110 @@ class BagOfWordsFeaturizer():
         with open(os.path.join(self.outpath, 'feature_config.json'), 'w') as f:
             json.dump(self.feature_config, f)
 
+    def transform(self, cohort_table_id, feature_table_id=None, outpath=None):
+        """
+        Featurizes a new cohort against the feature_order.csv, bin_lup.csv and
+        tfidf_transform.pkl saved in outpath by a previous call. Only the new
+        observations are extracted and encoded; vocab, bins and tfidf weights
+        are not refit. Saves features and labels in artifact_format.
+        Args:
+            cohort_table_id: cohort table of the new observations
+            feature_table_id: long form feature table for the new cohort,
+                default {feature_table_id}_transform
+            outpath: directory to save features, default {outpath}/transform
+        """
+        if feature_table_id is None:
+            feature_table_id = f"{self.feature_table_id}_transform"
+        if outpath is None:
+            outpath = os.path.join(self.outpath, 'transform')
+        df_vocab = load_table(self.outpath, 'feature_order', na_filter=False)
+        vocabulary = {f: int(i) for f, i in zip(df_vocab.features.values,
+                                                df_vocab.indices.values)}
+        oov_buckets = {term[:-len(OOV_SUFFIX)]: index
+                       for term, index in vocabulary.items()
+                       if term.endswith(OOV_SUFFIX)}
+        bin_lup = load_bin_lup(self.outpath)
+
+        # Point copies of the extractors at the new cohort
+        featurizer = copy.copy(self)
+        featurizer.cohort_table_id = cohort_table_id
+        featurizer.feature_table_id = feature_table_id
+        featurizer.extractors = []
+        for ext in self.extractors:
+            ext = copy.copy(ext)
+            ext.cohort_table_id = cohort_table_id
+            ext.feature_table_id = feature_table_id
+            if hasattr(ext, 'bin_lup'):
+                ext.bin_lup = bin_lup
+            featurizer.extractors.append(ext)
+        extractors.starr_extractors.REPLACE_TABLE = True
+        featurizer.construct_feature_timeline()
+        featurizer.construct_bag_of_words_rep()
+
+        dfs = download_queries({
+            'features': self._features_query(feature_table_id),
+            'labels': self._labels_query(cohort_table_id)
+        })
+        df_cohort = (dfs['labels']
+                     .sort_values('observation_id')
+                     .reset_index(drop=True))
+        csr = self.encode_features(dfs['features'], vocabulary, oov_buckets,
+                                   df_cohort.observation_id.values)
+
+        transform_path = os.path.join(self.outpath, 'tfidf_transform.pkl')
+        if os.path.exists(transform_path):
+            with open(transform_path, 'rb') as f:
+                transform = pickle.load(f)
+            csr = as_float32_csr(transform.transform(csr))
+        svd_path = os.path.join(self.outpath, 'svd_transform.pkl')
+        if os.path.exists(svd_path):
+            with open(svd_path, 'rb') as f:
+                svd = pickle.load(f)
+            features_svd = svd.transform(csr).astype(np.float32)
+        else:
+            features_svd = None
+
+        os.makedirs(outpath, exist_ok=True)
+        save_csr(csr, outpath, 'features', self.artifact_format)
+        if features_svd is not None:
+            np.save(os.path.join(outpath, 'features_svd.npy'), features_svd)
+        save_table(df_cohort, outpath, 'labels', self.artifact_format)
+
+    def _features_query(self, feature_table_id, years=None):
+        """
+        Query for bag of words rows of the extractor feature types, optionally
+        restricted to index_time years matching years (ex 'IN (2019, 2020)')
+        """
+        feature_types = [f"'{ext.__class__.__name__}'" for ext in self.extractors]
+        year_filter = ''
+        if years is not None:
+            year_filter = f"AND EXTRACT(YEAR FROM index_time) {years}"
+        return f"""
+        SELECT
+            observation_id, feature_type, feature, value
+        FROM
+            {feature_table_id}_bow
+        WHERE
+            feature_type in ({','.join(feature_types)})
+        {year_filter}
+        """
+
+    def _labels_query(self, cohort_table_id, years=None):
+        """
+        Query for cohort rows, optionally restricted to index_time years
+        matching years (ex 'IN (2019, 2020)')
+        """
+        year_filter = ''
+        if years is not None:
+            year_filter = f"WHERE EXTRACT(YEAR FROM index_time) {years}"
+        return f"""
+        SELECT
+            *
+        FROM
+            {cohort_table_id}
+        {year_filter}
+        """
+
     def construct_feature_timeline(self):
         """
         Calls extractors to create long form feature timeline
@@ -411,16 +914,37 @@ class BagOfWordsFeaturizer():
         style classifiers. 
         """
 
-        # Go from timeline to counts
+        # Go from timeline to counts, bucketed by recency if horizons given
+        if self.horizons is None:
+            feature = "feature"
+        else:
+            cases = []
+            for name, hours in self.horizons.items():
+                if hours is None:
+                    cases.append(f"ELSE '{name}'")
+                    break
+                cases.append(
+                    f"WHEN TIMESTAMP_DIFF(index_time, feature_time, HOUR) "
+                    f"<= {hours} THEN '{name}'")
+            else:
+                cases.append("ELSE NULL")
+            feature = (f"CONCAT(feature, '@', CASE {' '.join(cases)} END)")
         query = f"""
         CREATE OR REPLACE TABLE {self.feature_table_id}_bow AS (
         SELECT 
             observation_id, index_time, feature_type, feature, COUNT(*) value 
-        FROM 
-            {self.feature_table_id}
-        WHERE 
-            feature_type IS NOT NULL
-        AND
+        FROM (
+            SELECT
+                observation_id, index_time, feature_type,
+                {feature} feature
+            FROM 
+                {self.feature_table_id}
+            WHERE 
+                feature_type IS NOT NULL
+            AND
+                feature IS NOT NULL
+        )
+        WHERE
             feature IS NOT NULL
         GROUP BY 
             observation_id, index_time, feature_type, feature
@@ -429,62 +953,170 @@ class BagOfWordsFeaturizer():
         query_job = self.client.query(query)
         query_job.result()
 
-    def construct_sparse_matrix(self, train_features, apply_features):
+    def construct_sparse_matrix(self, train_features, apply_features,
+                                obs_ids):
         """
         Takes long form feature timeline matrix and builds up a scipy csr
-        matrix without the costly pivot operation. 
+        matrix without the costly pivot operation. Row i holds the features of
+        obs_ids[i]; observations without features get an empty row.
+        Returns the matrix and the vocabulary built from train_features.
         """
         train_features = (train_features
+                          .sort_values(['observation_id', 'feature'],
+                                       kind='stable')
                           .groupby('observation_id')
                           .agg({'feature': lambda x: list(x),
-                                'value': lambda x: list(x)})
+                                'feature_type': lambda x: list(x)})
                           .reset_index()
                           )
         train_feature_names = [doc for doc in train_features.feature.values]
-        train_feature_values = [doc for doc in train_features['value'].values]
-        train_obs_id = [id_ for id_ in train_features.observation_id.values]
+        train_feature_types = [doc for doc in
+                               train_features.feature_type.values]
 
-        apply_features = (apply_features
-                          .groupby('observation_id')
-                          .agg({'feature': lambda x: list(x),
-                                'value': lambda x: list(x)})
-                          .reset_index()
-                          )
-        apply_features_names = [doc for doc in apply_features.feature.values]
-        apply_features_values = [doc for doc in apply_features['value'].values]
-        apply_obs_id = [id_ for id_ in apply_features.observation_id.values]
-
-        vocabulary = self._build_vocab(train_feature_names)
-        indptr = [0]
-        indices = []
-        data = []
-        for i, d in enumerate(apply_features_names):
-            for j, term in enumerate(d):
-                if term not in vocabulary:
-                    continue
-                else:
-                    indices.append(vocabulary[term])
-                    data.append(apply_features_values[i][j])
-                if j == 0:
-                    # Add zero to data and max index in vocabulary to indices in
-                    # case max feature indice isn't in apply features.
-                    indices.append(len(vocabulary)-1)
-                    data.append(0)
-            indptr.append(len(indices))
-
-        csr_data = csr_matrix((data, indices, indptr), dtype=float)
-
-        return csr_data, apply_obs_id, vocabulary
-
-    def _build_vocab(self, data):
+        vocabulary, oov_buckets = self._build_vocab(train_feature_names,
+                                                    train_feature_types)
+        csr_data = self.encode_features(apply_features, vocabulary,
+                                        oov_buckets, obs_ids)
+
+        return csr_data, vocabulary
+
+    def encode_features(self, apply_features, vocabulary, oov_buckets,
+                        obs_ids):
+        """
+        Encodes long form features as a csr matrix with columns given by
+        vocabulary and row i holding the features of obs_ids[i]. Rows are
+        placed through an observation_id to row index mapping so no ordering
+        of apply_features is assumed.
+        """
+        row_index = pd.Series(np.arange(len(obs_ids)), index=obs_ids)
+        rows = apply_features.observation_id.map(row_index)
+        cols = apply_features.feature.map(vocabulary)
+        if oov_buckets:
+            cols = cols.fillna(apply_features.feature_type.map(oov_buckets))
+        keep = (rows.notna() & cols.notna()).values
+
+        # Duplicate (row, col) pairs, ex pruned terms sharing an out of
+        # vocabulary column, are summed
+        csr_data = csr_matrix(
+            (apply_features['value'].values[keep].astype(np.float32),
+             (rows.values[keep].astype(np.int64),
+              cols.values[keep].astype(np.int64))),
+            shape=(len(obs_ids), len(vocabulary)), dtype=np.float32)
+        csr_data.sum_duplicates()
+
+        return as_float32_csr(csr_data)
+
+    def _build_vocab(self, data, feature_types):
         """
         Builds vocabulary of terms from the data. Assigns each unique term
-        to a monotonically increasing integer
+        to a monotonically increasing integer in order of first appearance,
+        pruning by document frequency as configured. Returns the vocabulary
+        and the out of vocabulary column of each pruned feature type.
         """
-        vocabulary = {}
-        for i, d in enumerate(data):
-            for j, term in enumerate(d):
-                vocabulary.setdefault(term, len(vocabulary))
-        return vocabulary
+        df_counts, term_types = {}, {}
+        for d, t in zip(data, feature_types):
+            for term, feature_type in zip(d, t):
+                term_types.setdefault(term, feature_type)
+            for term in set(d):
+                df_counts[term] = df_counts.get(term, 0) + 1
+        term_stats = pd.DataFrame(data={
+            'feature': list(term_types.keys()),
+            'feature_type': list(term_types.values()),
+            'df': [df_counts[term] for term in term_types]
+        })
+        if self.horizons is not None:
+            # Stack columns by horizon
+            order = {name: i for i, name in enumerate(self.horizons)}
+            horizon = term_stats.feature.str.rsplit('@', n=1).str[-1]
+            term_stats = term_stats.iloc[np.argsort(
+                horizon.map(order).values, kind='stable')]
+        return build_vocabulary(term_stats, len(data), min_df=self.min_df,
+                                max_df=self.max_df,
+                                max_features=self.max_features)
 
 
+class BagOfWordsAndSequenceFeaturizer():
+    """
+    Builds the long form feature timeline once and emits both the sparse bag
+    of words matrices of BagOfWordsFeaturizer and the per day sequences of
+    SequenceFeaturizer, so GRU and gbm models can be compared on one
+    extraction. Both share one split definition and one vocabulary (sequence
+    token id = bag of words column index + 1).
+    """
+
+    def __init__(self, cohort_table_id, feature_table_id, extractors,
+                 train_years, val_years, test_years, label_columns,
+                 outpath='./features', project='som-nero-phi-jonc101',
+                 dataset='shc_core_2021', feature_config=None, tfidf=True,
+                 integer_tokens=False, min_df=1, max_df=1.0,
+                 max_features=None, svd_components=None,
+                 artifact_format='npz', max_days=None, max_tokens_per_day=None,
+                 feature_type_priority=None, coalesce_old_days=False):
+        """
+        Args:
+            cohort_table_id: ex 'mining-clinical-decisions.conor_db.table_name'
+            feature_table_id: ex
+                'mining-clinical-decisions.conor_db.feature_table'
+            extractors: list of extractors to pull data from
+            train_years: list of years to include in training set
+            val_years: list of years to include in validation set. Bag of words
+                train matrices hold train_years + val_years rows, trainers carve
+                their validation set from the most recent of these. The shared
+                vocabulary, tfidf and svd are fit on train_years rows only
+            test_years: list of years to include in the test set
+            label_columns: list of columns desingated as labels in cohort table
+            outpath: path to dump features, bag of words features are saved to
+                {outpath}/bag_of_words and sequences to {outpath}/sequence
+            project: bq project id to extract data from
+            dataset: bq dataset with project to extract data from
+            feature_config: dictionary with feature types, bins and look back
+                windows.
+            tfidf: if true apply a tfidf transform to bag of words features
+            integer_tokens: see SequenceFeaturizer
+            min_df, max_df, max_features: vocabulary pruning, see
+                BagOfWordsFeaturizer
+            svd_components: dense svd compression of bag of words features,
+                see BagOfWordsFeaturizer
+            artifact_format: format of bag of words artifacts, see
+                BagOfWordsFeaturizer
+            max_days, max_tokens_per_day, feature_type_priority,
+                coalesce_old_days: sequence length bounds, see
+                SequenceFeaturizer
+        """
+        self.extractors = extractors
+        self.outpath = outpath
+        self.bow_featurizer = BagOfWordsFeaturizer(
+            cohort_table_id, feature_table_id, extractors,
+            train_years=list(train_years) + list(val_years),
+            test_years=list(test_years),
+            outpath=os.path.join(outpath, 'bag_of_words'), project=project,
+            dataset=dataset, feature_config=feature_config, tfidf=tfidf,
+            from_table=True, min_df=min_df, max_df=max_df,
+            max_features=max_features, svd_components=svd_components,
+            artifact_format=artifact_format, fit_years=list(train_years))
+        self.sequence_featurizer = SequenceFeaturizer(
+            cohort_table_id, feature_table_id, train_years, val_years,
+            test_years, label_columns,
+            outpath=os.path.join(outpath, 'sequence'), project=project,
+            dataset=dataset, feature_config=feature_config,
+            integer_tokens=integer_tokens, from_table=True,
+            max_days=max_days, max_tokens_per_day=max_tokens_per_day,
+            feature_type_priority=feature_type_priority,
+            coalesce_old_days=coalesce_old_days)
+
+    def __call__(self):
+        """
+        Extracts features once and saves both representations
+        """
+        self.bow_featurizer.construct_feature_timeline()
+        self.bow_featurizer.construct_bag_of_words_rep()
+        self.bow_featurizer()
+
+        # Reuse bag of words vocab and bins for the sequences
+        df_vocab = load_table(self.bow_featurizer.outpath, 'feature_order',
+                              na_filter=False)
+        self.sequence_featurizer.vocabulary = {
+            f: int(i) + 1 for f, i in zip(df_vocab.features.values,
+                                          df_vocab.indices.values)}
+        self.sequence_featurizer.lups = self.bow_featurizer.lups
+        self.sequence_featurizer()
@@ -0,0 +1,81 @@
+"""
+Definition of build_vocabulary, shared by BagOfWordsFeaturizer and
+SequenceFeaturizer so both prune terms the same way.
+"""
+import pandas as pd
+
+OOV_SUFFIX = '_OOV'
+
+
+def oov_term(feature_type):
+    """
+    Name of the out of vocabulary bucket that collects pruned terms of a
+    feature type, ex 'MedicationExtractor_OOV'
+    """
+    return f"{feature_type}{OOV_SUFFIX}"
+
+
+def _df_threshold(value, num_docs):
+    """
+    Interprets a document frequency option like sklearn does: ints are
+    absolute document counts, floats are proportions of num_docs.
+    """
+    if isinstance(value, float):
+        return value * num_docs
+    return value
+
+
+def build_vocabulary(term_stats, num_docs, min_df=1, max_df=1.0,
+                     max_features=None, start=0):
+    """
+    Builds a frequency pruned vocabulary from training set term statistics.
+    Terms outside [min_df, max_df] or outside the max_features most frequent
+    terms are collapsed into one out of vocabulary bucket per feature_type.
+    With default arguments nothing is pruned and no buckets are created.
+    Args:
+        term_stats: dataframe with columns feature, feature_type and df (number
+            of training observations containing the feature). Row order sets
+            the order of kept terms.
+        num_docs: number of training observations
+        min_df: terms in fewer documents are pruned (int count or float
+            proportion)
+        max_df: terms in more documents are pruned (int count or float
+            proportion)
+        max_features: if not None, keep only this many terms ordered by
+            document frequency
+        start: index assigned to the first term (1 reserves 0 for padding)
+    Returns:
+        vocabulary: dict mapping kept terms and oov buckets to indices
+        oov_buckets: dict mapping feature_type to the index of its bucket
+    """
+    term_stats = pd.DataFrame(term_stats).reset_index(drop=True)
+    keep = ((term_stats['df'] >= _df_threshold(min_df, num_docs)) &
+            (term_stats['df'] <= _df_threshold(max_df, num_docs)))
+    if max_features is not None:
+        # Stable sort so ties keep their original order
+        ranked = (term_stats[keep]
+                  .sort_values('df', ascending=False, kind='stable')
+                  .head(max_features))
+        keep = term_stats.index.isin(ranked.index)
+
+    vocabulary = {}
+    for term in term_stats.loc[keep, 'feature'].values:
+        vocabulary.setdefault(term, len(vocabulary) + start)
+
+    oov_buckets = {}
+    for feature_type in term_stats.loc[~keep, 'feature_type'].unique():
+        bucket = oov_term(feature_type)
+        vocabulary.setdefault(bucket, len(vocabulary) + start)
+        oov_buckets[feature_type] = vocabulary[bucket]
+    return vocabulary, oov_buckets
+
+
+def lookup_term(term, feature_type, vocabulary, oov_buckets):
+    """
+    Index of term in vocabulary, falling back to the out of vocabulary bucket
+    of its feature type. Returns None if neither exists.
+    """
+    index = vocabulary.get(term)
+    if index is None:
+        index = oov_buckets.get(feature_type)
+    return index
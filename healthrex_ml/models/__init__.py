@@ -1 +1,9 @@
 from healthrex_ml.models.sequence_models import PatientDayGRU
+from healthrex_ml.models.sequence_models import GRUStateCache
+from healthrex_ml.models.sequence_models import PatientDayTransformer
+from healthrex_ml.models.export import (
+    export_torchscript,
+    load_exported,
+    benchmark_inference,
+    benchmark_training
+)
@@ -0,0 +1,163 @@
+"""
+TorchScript export of sequence models for CPU scoring nodes, with optional
+dynamic int8 quantization of GRU and linear layers, and benchmarks that
+compare eager, scripted and quantized models at inference and different
+architectures (ex PatientDayGRU vs PatientDayTransformer) in training.
+
+Scripted models take lengths as a tensor:
+    model = load_exported('model.pt')
+    yhat = model(batch['sequence'], torch.as_tensor(batch['lengths']))
+"""
+import copy
+import time
+import numpy as np
+import pandas as pd
+from sklearn.metrics import roc_auc_score
+import torch
+from torch.ao.quantization import quantize_dynamic
+from torch.utils.data import DataLoader
+
+
+def quantize(model):
+    """
+    Copy of model with GRU and linear weights dynamically quantized to int8.
+    Embedding tables stay float32.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    return quantize_dynamic(model, {torch.nn.GRU, torch.nn.Linear},
+                            dtype=torch.qint8)
+
+
+def script(model, quantized=False):
+    """
+    TorchScript module of model (packing logic included), optionally
+    quantized first
+    """
+    model = quantize(model) if quantized else copy.deepcopy(model).cpu().eval()
+    return torch.jit.script(model)
+
+
+def export_torchscript(model, path, quantized=False):
+    """
+    Saves a scripted (and optionally int8 quantized) model to path. The
+    artifact loads with load_exported, without the python model class.
+    """
+    scripted = script(model, quantized=quantized)
+    torch.jit.save(scripted, path)
+    return scripted
+
+
+def load_exported(path):
+    return torch.jit.load(path, map_location='cpu')
+
+
+def predict_batches(model, batches):
+    """
+    Probabilities of model over a list of collated batches
+    """
+    predictions = []
+    with torch.inference_mode():
+        for batch in batches:
+            output = model(batch['sequence'].long(),
+                           torch.as_tensor(batch['lengths']),
+                           batch.get('offsets'), batch.get('time_deltas'))
+            predictions.append(torch.sigmoid(output).numpy())
+    return np.concatenate(predictions)
+
+
+def benchmark_inference(models, dataset, collate_fn, batch_sizes=(1, 32, 256),
+                        max_batches=50, num_threads=None):
+    """
+    Compares latency and throughput of models on CPU across batch sizes and
+    their AUC on dataset (ex the validation set).
+    Args:
+        models: dict of name to model, ex {'eager': model,
+            'scripted': script(model), 'quantized': script(model, True)}.
+            The first model is the reference for prediction differences.
+        dataset: SequenceDataset to score
+        collate_fn: custom_collate or flat_collate
+        batch_sizes: batch sizes to time
+        max_batches: max number of batches timed per batch size
+        num_threads: torch intra op threads, defaults to torch's setting
+    Returns:
+        dataframe with one row per model and batch size
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    # Collate once up front so timings exclude data loading
+    full_batches = list(DataLoader(dataset, batch_size=max(batch_sizes),
+                                   collate_fn=collate_fn))
+    labels = np.concatenate([b['labels'].numpy() for b in full_batches])
+    reference = None
+    rows = []
+    for name, model in models.items():
+        model.eval()
+        predictions = predict_batches(model, full_batches)
+        if reference is None:
+            reference = predictions
+        auc = roc_auc_score(labels, predictions)
+        max_diff = float(np.abs(predictions - reference).max())
+        for batch_size in batch_sizes:
+            batches = []
+            for batch in DataLoader(dataset, batch_size=batch_size,
+                                    collate_fn=collate_fn):
+                batches.append(batch)
+                if len(batches) == max_batches:
+                    break
+            # Warm up (scripted models optimize on first calls)
+            predict_batches(model, batches[:2])
+            latencies = []
+            for batch in batches:
+                start = time.perf_counter()
+                predict_batches(model, [batch])
+                latencies.append(time.perf_counter() - start)
+            latencies = np.array(latencies)
+            num_samples = sum([len(b['lengths']) for b in batches])
+            rows.append({
+                'model': name,
+                'batch_size': batch_size,
+                'latency_ms_mean': 1000 * latencies.mean(),
+                'latency_ms_p95': 1000 * np.percentile(latencies, 95),
+                'samples_per_sec': num_samples / latencies.sum(),
+                'auc': auc,
+                'max_abs_diff': max_diff
+            })
+    return pd.DataFrame(rows)
+
+
+def benchmark_training(models, batches, lr=1e-3):
+    """
+    Training throughput of models on identical batches. Each model takes one
+    Adam step per batch after one warm up step.
+    Args:
+        models: dict of name to model
+        batches: list of collated batches (custom_collate or flat_collate)
+        lr: learning rate of the Adam optimizer
+    Returns:
+        dataframe with one row per model
+    """
+    criterion = torch.nn.BCEWithLogitsLoss()
+    num_samples = sum([len(b['lengths']) for b in batches])
+    num_days = sum([sum(b['lengths']) for b in batches])
+    rows = []
+    for name, model in models.items():
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+        elapsed = 0
+        for step, batch in enumerate([batches[0]] + list(batches)):
+            start = time.perf_counter()
+            optimizer.zero_grad()
+            output = model(batch['sequence'].int(), batch['lengths'],
+                           batch.get('offsets'), batch.get('time_deltas'))
+            loss = criterion(output, batch['labels'].float())
+            loss.backward()
+            optimizer.step()
+            if step > 0:
+                elapsed += time.perf_counter() - start
+        rows.append({
+            'model': name,
+            'sec_per_step': elapsed / len(batches),
+            'samples_per_sec': num_samples / elapsed,
+            'days_per_sec': num_days / elapsed
+        })
+    return pd.DataFrame(rows)
@@ -1,13 +1,54 @@
+from collections import OrderedDict
+from typing import Optional
+import hashlib
+import math
 import torch
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence
-from torch.nn.utils.rnn import pad_packed_sequence
+from torch.nn.utils.rnn import pad_sequence
+from torch.nn.utils.rnn import PackedSequence
 
 import pdb
 
+
+def pack_days(day_embed, lengths):
+    """
+    Scatters day embeddings of shape (total_days, E), ordered patient by
+    patient, directly into a PackedSequence without building a padded tensor.
+    Args:
+        day_embed: embeddings of every real day in the batch
+        lengths: number of days of each patient
+    """
+    lengths = torch.as_tensor(lengths, dtype=torch.int64)
+    sorted_lengths, sorted_indices = torch.sort(lengths, descending=True)
+    starts = torch.cumsum(lengths, dim=0) - lengths
+    steps = torch.arange(int(sorted_lengths[0]))
+    # mask[t, b] is true if the b-th longest patient has a day t
+    mask = steps[:, None] < sorted_lengths[None, :]
+    rows = (starts[sorted_indices][None, :] + steps[:, None])[mask]
+    batch_sizes = mask.sum(dim=1)
+    unsorted_indices = torch.empty_like(sorted_indices)
+    unsorted_indices[sorted_indices] = torch.arange(len(lengths))
+    device = day_embed.device
+    return PackedSequence(day_embed[rows.to(device)], batch_sizes,
+                          sorted_indices.to(device),
+                          unsorted_indices.to(device))
+
 class PatientDayGRU(torch.nn.Module):
     def __init__(self, vocab_size, embedding_size=512, hidden_size=256,
-         output_size=1, num_layers=1, dropout=0.2):
+         output_size=1, num_layers=1, dropout=0.2, sparse=False):
+        """
+        Args:
+            vocab_size: number of tokens, excluding the padding token 0
+            embedding_size: size of the day (bag of tokens) embedding
+            hidden_size: size of the GRU hidden state
+            output_size: number of outputs
+            num_layers: number of GRU layers
+            dropout: dropout of the classification layer
+            sparse: if true the embedding table gets sparse gradients, so an
+                optimizer step only touches tokens in the batch. SequenceTrainer
+                then steps it with SparseAdam.
+        """
         super(PatientDayGRU, self).__init__()
         self.vocab_size = vocab_size+1
         self.embedding_size = embedding_size
@@ -19,7 +60,8 @@ class PatientDayGRU(torch.nn.Module):
         self.embedding_layer = torch.nn.EmbeddingBag(
             num_embeddings=self.vocab_size,
             embedding_dim=self.embedding_size,
-            padding_idx=0
+            padding_idx=0,
+            sparse=sparse
         )
 
         # GRU
@@ -37,23 +79,332 @@ class PatientDayGRU(torch.nn.Module):
             torch.nn.Linear(int(self.hidden_size/2), self.output_size),
         )
 
-    def forward(self, x, x_lengths):
-        # Embed all patient days and reshape
-        x_stacked = torch.reshape(x, (x.shape[0]*x.shape[1], x.shape[2]))
-        x_embed = self.embedding_layer(x_stacked)
-        x_embed = torch.reshape(x_embed, 
-                               (x.shape[0], x.shape[1], x_embed.shape[1]))
-
-        # Pack padded days for input to GRU
-        packed_embeddings = pack_padded_sequence(x_embed,
-                                                 x_lengths,
-                                                 batch_first=True,
-                                                 enforce_sorted=False)
+    def forward(self, x, x_lengths,
+                offsets: Optional[torch.Tensor] = None,
+                time_deltas: Optional[torch.Tensor] = None):
+        """
+        x is either the (B, N_max, S_max) tensor of custom_collate, or with
+        offsets the 1-D token tensor of flat_collate, in which case only real
+        days are embedded and packed without padding. time_deltas is unused,
+        accepted so trainers call every sequence model the same way.
+        """
+        hidden = self.encode(x, x_lengths, offsets)
+        return self.classify(hidden)
+
+    def encode(self, x, x_lengths, offsets: Optional[torch.Tensor] = None):
+        """
+        Runs the GRU over every day, returns the final hidden state of shape
+        (num_layers, B, hidden_size)
+        """
+        if offsets is not None:
+            day_embed = self.embedding_layer(x, offsets.to(x.dtype))
+            packed_embeddings = pack_days(day_embed, x_lengths)
+        else:
+            # Embed all patient days and reshape
+            x_stacked = torch.reshape(x, (x.shape[0]*x.shape[1], x.shape[2]))
+            x_embed = self.embedding_layer(x_stacked)
+            x_embed = torch.reshape(x_embed, 
+                                   (x.shape[0], x.shape[1], x_embed.shape[1]))
+
+            # Pack padded days for input to GRU
+            packed_embeddings = pack_padded_sequence(x_embed,
+                                                     x_lengths,
+                                                     batch_first=True,
+                                                     enforce_sorted=False)
         output_packed, hidden = self.gru(packed_embeddings)
+        return hidden
+
+    def classify(self, hidden):
+        """
+        Logits from the final hidden state of the last GRU layer
+        """
+        yhat = self.classification_layer(hidden[-1])
+        return torch.squeeze(yhat, dim=1)
+
+    def advance(self, day, hidden=None):
+        """
+        Advances the GRU by one day per patient.
+        Args:
+            day: (B, S) padded token ids of the new day of each patient
+            hidden: (num_layers, B, hidden_size) state after the previous
+                day, None for the first day
+        Returns:
+            logits, new hidden state
+        """
+        day_embed = self.embedding_layer(day)
+        _, hidden = self.gru(day_embed[None], hidden)
+        return self.classify(hidden), hidden
+
+
+def days_digest(days):
+    """
+    Hash of the tokens of (num_days, S) padded days, independent of how wide
+    they were padded
+    """
+    nonzero_columns = torch.nonzero((days != 0).any(dim=0))
+    width = int(nonzero_columns.max()) + 1 if len(nonzero_columns) else 0
+    days = days[:, :width].to(torch.int64).contiguous()
+    return hashlib.sha1(str(tuple(days.shape)).encode() +
+                        days.cpu().numpy().tobytes()).hexdigest()
+
+
+class GRUStateCache():
+    """
+    Scores patients that are re-scored as days are added to their history
+    (ex daily inpatient scoring) in near constant time per score. Keeps, for
+    each patient, the GRU hidden state after every day but the last in a
+    bounded LRU store, and on each score advances the GRU over the days added
+    since plus the last day, which is always re-run because today's day can
+    gain tokens between scores. The cached days are checked against a hash
+    of the same days of the new history, so a rewritten history (ex oldest
+    days dropped or coalesced by SequenceFeaturizer(max_days=...)) falls back
+    to a full recompute, as do cache misses and entries computed by a
+    different model version.
+    """
+
+    def __init__(self, model, model_version=None, max_entries=10000):
+        """
+        Args:
+            model: trained PatientDayGRU
+            model_version: identifier of the model weights, entries cached
+                under another version are recomputed
+            max_entries: max number of patients kept, least recently scored
+                patients are evicted first
+        """
+        self.model = model
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.store = OrderedDict()
+
+    def update_model(self, model, model_version):
+        """
+        Swaps in new weights, stale entries are recomputed lazily
+        """
+        self.model = model
+        self.model_version = model_version
+
+    def invalidate(self, patient_id=None):
+        """
+        Drops one patient, or every patient if patient_id is None
+        """
+        if patient_id is None:
+            self.store.clear()
+        else:
+            self.store.pop(patient_id, None)
+
+    def score(self, patient_id, sequence):
+        """
+        Probability for a patient given their full history.
+        Args:
+            patient_id: key of the patient in the store
+            sequence: (num_days, S) padded token ids, oldest day first, as
+                saved by SequenceFeaturizer
+        """
+        self.model.eval()
+        num_prefix = sequence.shape[0] - 1
+        entry = self.store.get(patient_id)
+        with torch.inference_mode():
+            if entry is not None and entry['version'] == self.model_version \
+                    and entry['num_days'] <= num_prefix and \
+                    entry['digest'] == days_digest(
+                        sequence[:entry['num_days']]):
+                hidden = entry['hidden']
+                for d in range(entry['num_days'], num_prefix):
+                    _, hidden = self.model.advance(sequence[d][None], hidden)
+            elif num_prefix > 0:
+                hidden = self.model.encode(sequence[None, :num_prefix],
+                                           [num_prefix])
+            else:
+                hidden = None
+            logit, _ = self.model.advance(sequence[num_prefix][None], hidden)
+        self.store[patient_id] = {'num_days': num_prefix, 'hidden': hidden,
+                                  'digest': days_digest(sequence[:num_prefix]),
+                                  'version': self.model_version}
+        self.store.move_to_end(patient_id)
+        while len(self.store) > self.max_entries:
+            self.store.popitem(last=False)
+        return torch.sigmoid(logit).item()
+
+
+def embed_days(embedding_layer, x, x_lengths, offsets=None):
+    """
+    Embeds each day's bag of tokens into a (B, N_max, E) tensor from either
+    batch layout (see PatientDayGRU.forward). Padding days are zeros.
+    """
+    if offsets is not None:
+        day_embed = embedding_layer(x, offsets.to(x.dtype))
+        lengths = [int(l) for l in x_lengths]
+        return pad_sequence(torch.split(day_embed, lengths), batch_first=True)
+    x_stacked = torch.reshape(x, (x.shape[0]*x.shape[1], x.shape[2]))
+    x_embed = embedding_layer(x_stacked)
+    return torch.reshape(x_embed, (x.shape[0], x.shape[1], x_embed.shape[1]))
+
+
+class LocalSelfAttention(torch.nn.Module):
+    """
+    Multi head self attention where each day attends to itself and the
+    window - 1 days before it. Days are split into blocks of window days and
+    each block attends to itself and the previous block, so cost is
+    O(N * window) instead of O(N^2) in the number of days N.
+    """
+
+    def __init__(self, embedding_size, num_heads, window, dropout=0.1):
+        super(LocalSelfAttention, self).__init__()
+        self.num_heads = num_heads
+        self.window = window
+        self.dropout = dropout
+        self.qkv = torch.nn.Linear(embedding_size, 3 * embedding_size)
+        self.out = torch.nn.Linear(embedding_size, embedding_size)
+
+    def forward(self, x, mask):
+        """
+        Args:
+            x: (B, N, E) day representations
+            mask: (B, N) true for real days
+        """
+        B, N, E = x.shape
+        w, H = self.window, self.num_heads
+        num_blocks = math.ceil(N / w)
+        pad = num_blocks * w - N
+        x = F.pad(x, (0, 0, 0, pad))
+        mask = F.pad(mask, (0, pad), value=False)
+
+        # (B, H, num_blocks, w, E / H)
+        q, k, v = [t.reshape(B, num_blocks, w, H, E // H).permute(0, 3, 1, 2, 4)
+                   for t in self.qkv(x).chunk(3, dim=-1)]
+
+        def with_previous_block(t):
+            previous = F.pad(t, (0, 0, 0, 0, 1, 0))[:, :, :-1]
+            return torch.cat([previous, t], dim=3)
+        k, v = with_previous_block(k), with_previous_block(v)
+
+        # Key j of the 2w keys is day (block - 1) * w + j, query i is day
+        # block * w + i. Keep keys with 0 <= query day - key day < w.
+        i = torch.arange(w, device=x.device)[:, None]
+        j = torch.arange(2 * w, device=x.device)[None, :]
+        band = (j > i) & (j <= i + w)
+        key_mask = mask.reshape(B, num_blocks, w)
+        key_mask = torch.cat([F.pad(key_mask, (0, 0, 1, 0),
+                                    value=False)[:, :-1], key_mask], dim=2)
+        # (B, 1, num_blocks, w, 2w), broadcast over heads
+        attn_mask = band[None, None] & key_mask[:, None, :, None, :]
+        # Every query sees itself so padding rows don't produce NaNs
+        attn_mask = attn_mask | (j == i + w)[None, None]
+
+        out = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask,
+            dropout_p=self.dropout if self.training else 0.0)
+        out = out.permute(0, 2, 3, 1, 4).reshape(B, num_blocks * w, E)
+        return self.out(out[:, :N])
+
+
+class DayTransformerLayer(torch.nn.Module):
+    """
+    Pre layer norm transformer layer with local self attention
+    """
+
+    def __init__(self, embedding_size, num_heads, window, dropout=0.1):
+        super(DayTransformerLayer, self).__init__()
+        self.attention = LocalSelfAttention(embedding_size, num_heads, window,
+                                            dropout)
+        self.norm_1 = torch.nn.LayerNorm(embedding_size)
+        self.norm_2 = torch.nn.LayerNorm(embedding_size)
+        self.feed_forward = torch.nn.Sequential(
+            torch.nn.Linear(embedding_size, 4 * embedding_size),
+            torch.nn.GELU(),
+            torch.nn.Dropout(dropout),
+            torch.nn.Linear(4 * embedding_size, embedding_size),
+        )
+        self.dropout = torch.nn.Dropout(dropout)
+
+    def forward(self, x, mask):
+        x = x + self.dropout(self.attention(self.norm_1(x), mask))
+        x = x + self.dropout(self.feed_forward(self.norm_2(x)))
+        return x
+
+
+class PatientDayTransformer(torch.nn.Module):
+    """
+    Day level transformer over the same EmbeddingBag day encoder and batch
+    layouts as PatientDayGRU. Days attend within a local window, so cost is
+    near linear in days and all days are processed in parallel. Time is
+    encoded with an embedding of log bucketed days from index_time.
+    """
+
+    def __init__(self, vocab_size, embedding_size=256, num_heads=4,
+                 num_layers=2, window=16, output_size=1, dropout=0.1,
+                 num_time_buckets=64, sparse=False):
+        """
+        Args:
+            vocab_size: number of tokens, excluding the padding token 0
+            embedding_size: size of the day embedding and transformer layers
+            num_heads: number of attention heads
+            num_layers: number of transformer layers
+            window: number of days (including itself) each day attends to,
+                receptive field grows by window per layer
+            output_size: number of outputs
+            dropout: dropout of transformer and classification layers
+            num_time_buckets: number of log2 buckets of time deltas
+            sparse: if true the embedding table gets sparse gradients, see
+                PatientDayGRU
+        """
+        super(PatientDayTransformer, self).__init__()
+        self.vocab_size = vocab_size+1
+        self.embedding_size = embedding_size
+        self.output_size = output_size
+        self.num_time_buckets = num_time_buckets
+
+        self.embedding_layer = torch.nn.EmbeddingBag(
+            num_embeddings=self.vocab_size,
+            embedding_dim=self.embedding_size,
+            mode='mean',
+            padding_idx=0,
+            sparse=sparse
+        )
+        self.time_embedding = torch.nn.Embedding(num_time_buckets,
+                                                 embedding_size)
+        self.layers = torch.nn.ModuleList([
+            DayTransformerLayer(embedding_size, num_heads, window, dropout)
+            for _ in range(num_layers)
+        ])
+        self.norm = torch.nn.LayerNorm(embedding_size)
+
+        # Classification
+        self.classification_layer = torch.nn.Sequential(
+            torch.nn.Linear(embedding_size, int(embedding_size/2)),
+            torch.nn.Dropout(dropout),
+            torch.nn.ReLU(),
+            torch.nn.Linear(int(embedding_size/2), self.output_size),
+        )
+
+    def time_buckets(self, time_deltas):
+        """
+        Four buckets per doubling of days from index_time
+        """
+        buckets = torch.floor(torch.log2(1 + time_deltas.clamp(min=0).float())
+                              * 4)
+        return buckets.long().clamp(max=self.num_time_buckets - 1)
+
+    def forward(self, x, x_lengths, offsets=None, time_deltas=None):
+        """
+        Same inputs as PatientDayGRU.forward plus the (B, N_max) time_deltas
+        of custom_collate / flat_collate. Without time_deltas days are
+        encoded by their position from the last day.
+        """
+        day_embed = embed_days(self.embedding_layer, x, x_lengths, offsets)
+        lengths = torch.as_tensor(x_lengths, device=day_embed.device)
+        steps = torch.arange(day_embed.shape[1], device=day_embed.device)
+        mask = steps[None, :] < lengths[:, None]
+        if time_deltas is None:
+            time_deltas = (lengths[:, None] - 1 - steps[None, :]).clamp(min=0)
+        hidden = day_embed + self.time_embedding(
+            self.time_buckets(time_deltas[:, :day_embed.shape[1]]))
+        for layer in self.layers:
+            hidden = layer(hidden, mask)
+        hidden = self.norm(hidden)
 
-        output_padded, output_lengths = pad_packed_sequence(
-            output_packed, batch_first=True)
-        
-        hidden = torch.squeeze(hidden, dim=0)
-        yhat = self.classification_layer(hidden)
+        # Mean over real days
+        mask = mask.unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        yhat = self.classification_layer(pooled)
         return torch.squeeze(yhat, dim=1)
@@ -1,6 +1,14 @@
 from healthrex_ml.trainers.pytorch_trainers import SequenceTrainer
+from healthrex_ml.trainers.search import GRUHyperparameterSearch
+from healthrex_ml.trainers.distributed import (
+    init_distributed,
+    spawn,
+    distributed_dataloader
+)
 from healthrex_ml.trainers.sklearn_trainers import (
     LightGBMTrainer,
     BaselineModelTrainer,
-    NGBoostTrainer
+    NGBoostTrainer,
+    MultiTaskTrainer,
+    load_split_data
 )
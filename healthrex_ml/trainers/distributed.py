@@ -0,0 +1,164 @@
+"""
+Helpers to run SequenceTrainer data parallel over several CPU processes with
+torch.distributed and the gloo backend.
+
+Local processes:
+    spawn(main, nprocs=8)  # main(rank, world_size) builds and runs a trainer
+Across nodes on a shared filesystem, launch one process per slot with
+torchrun (which sets RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT) and call
+init_distributed() at the top of the script.
+"""
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+
+def is_distributed():
+    """
+    True if a process group has been initialized
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """
+    Only rank 0 writes checkpoints, tensorboard logs and predictions
+    """
+    return get_rank() == 0
+
+
+def init_distributed(rank=None, world_size=None, backend='gloo',
+                     num_threads=None):
+    """
+    Initializes the process group from arguments or the RANK and WORLD_SIZE
+    environment variables set by torchrun.
+    Args:
+        rank: rank of this process
+        world_size: total number of processes
+        backend: torch.distributed backend, gloo for CPU training
+        num_threads: intra op threads per process, defaults to the cores of
+            the host split evenly across local processes
+    Returns:
+        rank, world_size
+    """
+    rank = int(os.environ.get('RANK', 0)) if rank is None else rank
+    world_size = (int(os.environ.get('WORLD_SIZE', 1)) if world_size is None
+                  else world_size)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    if num_threads is None:
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+        num_threads = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(num_threads)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    return rank, world_size
+
+
+def _spawn_worker(rank, fn, world_size, backend, args):
+    init_distributed(rank, world_size, backend)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def spawn(fn, nprocs, args=(), backend='gloo', master_port='29500'):
+    """
+    Runs fn(rank, world_size, *args) in nprocs local processes joined in one
+    process group
+    """
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = str(master_port)
+    mp.spawn(_spawn_worker, args=(fn, nprocs, backend, args), nprocs=nprocs,
+             join=True)
+
+
+def distributed_dataloader(dataset, batch_size, collate_fn, shuffle=True,
+                           seed=0, **kwargs):
+    """
+    DataLoader over the shard of dataset assigned to this rank. Call
+    sampler.set_epoch(epoch) each epoch to reshuffle, SequenceTrainer does
+    this for you. kwargs are passed to DataLoader.
+    """
+    sampler = DistributedSampler(dataset, num_replicas=get_world_size(),
+                                 rank=get_rank(), shuffle=shuffle, seed=seed)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                      collate_fn=collate_fn, **kwargs)
+
+
+def is_sharded(dataloader):
+    """
+    True if dataloader yields only this rank's shard, through a
+    DistributedSampler or a batch sampler (ex BucketBatchSampler) with
+    num_replicas equal to the world size
+    """
+    if isinstance(dataloader.sampler, DistributedSampler):
+        return True
+    return getattr(dataloader.batch_sampler, 'num_replicas', 1) == \
+        get_world_size()
+
+
+def set_sampler_epoch(dataloader, epoch):
+    """
+    Reshuffles distributed samplers (or batch samplers) of dataloader
+    """
+    if dataloader is None:
+        return
+    for sampler in (dataloader.sampler, dataloader.batch_sampler):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+
+
+def all_gather_arrays(*arrays):
+    """
+    Concatenates numpy arrays held by every rank, in rank order. Returns
+    arrays unchanged when not distributed.
+    """
+    if not is_distributed():
+        return arrays
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, arrays)
+    return tuple(np.concatenate([g[i] for g in gathered])
+                 for i in range(len(arrays)))
+
+
+def drop_padded_duplicates(indices, *arrays):
+    """
+    DistributedSampler pads shards with repeated samples so every rank gets
+    the same number. Keeps the first row of each dataset index in gathered
+    arrays. Returns arrays unchanged if indices are missing (None).
+    """
+    if any([i is None for i in indices]):
+        return arrays
+    _, keep = np.unique(np.asarray(indices, dtype=np.int64),
+                        return_index=True)
+    keep = np.sort(keep)
+    return tuple(array[keep] for array in arrays)
+
+
+def all_reduce_mean(value):
+    """
+    Mean of a python float across ranks
+    """
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item() / get_world_size()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
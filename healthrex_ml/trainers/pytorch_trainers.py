@@ -1,34 +1,284 @@
 """
 Definition of SequenceTrainer
 """
+from contextlib import nullcontext
 import os
 import json
+import math
+import random
+import resource
+import time
 import numpy as np
+import pandas as pd
 from sklearn.metrics import roc_auc_score
 import torch
 from torch.optim import Adam
+from torch.optim import SparseAdam
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+from torch.nn.parallel import DistributedDataParallel
+from torch.profiler import profile
+from torch.profiler import schedule
+from torch.profiler import tensorboard_trace_handler
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
 from healthrex_ml.featurizers import DEFAULT_LAB_COMPONENT_IDS
 from healthrex_ml.featurizers import DEFAULT_FLOWSHEET_FEATURES
+from healthrex_ml.trainers.distributed import all_gather_arrays
+from healthrex_ml.trainers.distributed import all_reduce_mean
+from healthrex_ml.trainers.distributed import barrier
+from healthrex_ml.trainers.distributed import drop_padded_duplicates
+from healthrex_ml.trainers.distributed import is_distributed
+from healthrex_ml.trainers.distributed import is_main_process
+from healthrex_ml.trainers.distributed import is_sharded
+from healthrex_ml.trainers.distributed import set_sampler_epoch
 
 import pdb
 
+
+class SparseDenseOptimizer():
+    """
+    Steps sparse embedding tables with SparseAdam and all other parameters
+    with a dense optimizer of the same class as the optimizer it was built
+    from. That optimizer is left untouched and exposed as param_groups, so
+    schedulers attached to it keep working: before each step the
+    hyperparameters of each of its groups are copied to the matching dense
+    group and its learning rate to the matching SparseAdam group. Groups
+    are matched by position, since load_state_dict replaces the group dicts.
+    """
+
+    def __init__(self, optimizer, sparse_optimizer, dense_optimizer,
+                 group_map):
+        """
+        Args:
+            optimizer: optimizer given by the caller, source of learning rates
+            sparse_optimizer: SparseAdam over the sparse embedding weights
+            dense_optimizer: optimizer over the remaining parameters
+            group_map: (dense group index or None, sparse group index or
+                None) for each param group of optimizer
+        """
+        self.optimizer = optimizer
+        self.sparse_optimizer = sparse_optimizer
+        self.dense_optimizer = dense_optimizer
+        self.group_map = group_map
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    def zero_grad(self, set_to_none=True):
+        self.sparse_optimizer.zero_grad(set_to_none=set_to_none)
+        if self.dense_optimizer is not None:
+            self.dense_optimizer.zero_grad(set_to_none=set_to_none)
+
+    def step(self):
+        for group, (dense_index, sparse_index) in zip(
+                self.optimizer.param_groups, self.group_map):
+            if dense_index is not None:
+                dense_group = self.dense_optimizer.param_groups[dense_index]
+                for key, value in group.items():
+                    if key != 'params':
+                        dense_group[key] = value
+            if sparse_index is not None:
+                self.sparse_optimizer.param_groups[sparse_index]['lr'] = \
+                    group['lr']
+        self.sparse_optimizer.step()
+        if self.dense_optimizer is not None:
+            self.dense_optimizer.step()
+
+    def state_dict(self):
+        """
+        State of both optimizers and the hyperparameters (ex lr set by a
+        scheduler) of each param group of the caller's optimizer
+        """
+        return {'sparse': self.sparse_optimizer.state_dict(),
+                'dense': (self.dense_optimizer.state_dict()
+                          if self.dense_optimizer is not None else None),
+                'groups': [{k: v for k, v in group.items() if k != 'params'}
+                           for group in self.optimizer.param_groups]}
+
+    def load_state_dict(self, state_dict):
+        self.sparse_optimizer.load_state_dict(state_dict['sparse'])
+        if self.dense_optimizer is not None:
+            self.dense_optimizer.load_state_dict(state_dict['dense'])
+        for group, saved in zip(self.optimizer.param_groups,
+                                state_dict.get('groups', [])):
+            group.update(saved)
+
+
+def split_sparse_optimizer(model, optimizer):
+    """
+    If model has embeddings with sparse gradients, returns a
+    SparseDenseOptimizer stepping their weights with SparseAdam and the
+    other parameters of each param group of optimizer with a new optimizer
+    of its class. optimizer itself is not modified. Otherwise returns
+    optimizer unchanged.
+    """
+    if isinstance(optimizer, SparseDenseOptimizer):
+        return optimizer
+    sparse_ids = set([
+        id(m.weight) for m in model.modules()
+        if isinstance(m, (torch.nn.Embedding, torch.nn.EmbeddingBag))
+        and m.sparse
+    ])
+    if not sparse_ids:
+        return optimizer
+    dense_groups, sparse_groups, group_positions = [], [], []
+    for group in optimizer.param_groups:
+        dense_params = [p for p in group['params'] if id(p) not in sparse_ids]
+        sparse_params = [p for p in group['params'] if id(p) in sparse_ids]
+        positions = [None, None]
+        if dense_params:
+            positions[0] = len(dense_groups)
+            dense_group = {k: v for k, v in group.items() if k != 'params'}
+            dense_group['params'] = dense_params
+            dense_groups.append(dense_group)
+        if sparse_params:
+            positions[1] = len(sparse_groups)
+            sparse_group = {k: group[k] for k in ('lr', 'betas', 'eps')
+                            if k in group}
+            sparse_group['params'] = sparse_params
+            sparse_groups.append(sparse_group)
+        group_positions.append(positions)
+    sparse_optimizer = SparseAdam(sparse_groups)
+    dense_optimizer = (type(optimizer)(dense_groups, **optimizer.defaults)
+                       if dense_groups else None)
+    return SparseDenseOptimizer(optimizer, sparse_optimizer, dense_optimizer,
+                                group_positions)
+
+
+def mark_last(iterable):
+    """
+    Yields (item, is_last) pairs of iterable, looking one item ahead
+    """
+    iterator = iter(iterable)
+    try:
+        previous = next(iterator)
+    except StopIteration:
+        return
+    for item in iterator:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB (ru_maxrss is KB on linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def batch_token_stats(batch):
+    """
+    Number of real (non padding) tokens in a batch and the fraction of the
+    batch tensor that is padding. flat_collate batches have no padding.
+    """
+    sequence = batch['sequence']
+    if batch.get('offsets') is not None:
+        return sequence.numel(), 0.0
+    num_tokens = int((sequence != 0).sum())
+    return num_tokens, 1 - num_tokens / max(sequence.numel(), 1)
+
+
+def atomic_save(obj, path):
+    """
+    torch.save to a temporary file then rename, so a job killed mid write
+    never leaves a truncated checkpoint at path
+    """
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_model_state(path, map_location=None, weights_only=True):
+    """
+    Model state dict from a model_{epoch}.pt weights file, or from a full
+    training checkpoint (checkpoint_latest.pt). Full checkpoints hold numpy
+    and python RNG state, so load them with weights_only=False and only
+    from trusted paths.
+    """
+    state = torch.load(path, map_location=map_location,
+                       weights_only=weights_only)
+    if 'model' in state and 'epoch' in state:
+        return state['model']
+    return state
+
 class SequenceTrainer():
     """
     Used to train models that leverage SequenceFeaturizer.  Example model
     classes include GRUs, GRUs with Attention, Transformers. 
+
+    If a torch.distributed process group is initialized (see
+    healthrex_ml.trainers.distributed) the model is wrapped in
+    DistributedDataParallel, each rank trains on its shard of the
+    dataloaders, and predictions are gathered across ranks for AUC.
+    Checkpoints, tensorboard logs and yhats are written by rank 0 only.
     """
 
     def __init__(self, outpath, model, criterion, optimizer, device,
                  train_dataloader, val_dataloader, test_dataloader,
                  stopping_metric, num_epochs=100, scheduler=None,
-                 stopping_tolerance=20):
+                 stopping_tolerance=20, task='label', log_every=1,
+                 profile_steps=None, resume=False, effective_batch_size=None):
+        """
+        Args:
+            outpath: directory for checkpoints, tensorboard logs and yhats
+            scheduler: if not None, stepped once after every epoch's
+                validation (ReduceLROnPlateau with the stopping metric)
+            test_dataloader: if not None, predictions of the best checkpoint
+                on it are written to {task}_classification_yhats.csv
+            task: name of the label, used to name the yhats file
+            log_every: log step timings and throughput to tensorboard every
+                log_every training steps
+            profile_steps: if not None, capture a torch.profiler trace of
+                this many training steps (after 1 wait and 1 warmup step) to
+                outpath/profiler
+            resume: if true and outpath has a checkpoint_latest.pt, restore
+                the model, optimizer, scheduler, RNG and early stopping state
+                from it and continue after its epoch
+            effective_batch_size: if not None, gradients of consecutive
+                batches are accumulated until they cover at least this many
+                observations before each optimizer step. Use with token
+                budget batches (BucketBatchSampler(max_tokens=...)) whose
+                batch sizes vary. When distributed (BucketBatchSampler with
+                num_replicas and rank), ranks step together every
+                ceil(effective_batch_size / mean batch size over all ranks)
+                batches instead, see accumulation_steps.
+        """
         self.outpath = outpath
+        if is_distributed() and not is_sharded(train_dataloader):
+            raise ValueError("train_dataloader must shard the data across "
+                             "ranks when distributed, use "
+                             "distributed_dataloader or a batch sampler with "
+                             "num_replicas and rank")
+        if is_distributed() and \
+                not isinstance(model, DistributedDataParallel):
+            model = DistributedDataParallel(model)
         self.model = model
         self.criterion = criterion
-        self.optimizer = optimizer
+        # Sparse embedding tables are stepped with SparseAdam
+        self.optimizer = split_sparse_optimizer(self.unwrap_model(),
+                                                optimizer)
         self.device = device
         self.train_dataloader = train_dataloader
         self.val_dataloader = val_dataloader
@@ -37,61 +287,312 @@ class SequenceTrainer():
         self.stopping_tolerance = stopping_tolerance
         self.num_epochs = num_epochs
         self.scheduler = scheduler
-        self.writer = SummaryWriter(self.outpath)
+        self.task = task
+        self.log_every = log_every
+        self.profile_steps = profile_steps
+        self.profiler = None
+        self.resume = resume
+        self.effective_batch_size = effective_batch_size
+        self.global_step = 0
+        self.start_epoch = 0
+        self.best_epoch = None
+        self.best_stopping_metric = 0
+        self.tolerance_counter = 0
+        self.stopped = False
+        self.writer = SummaryWriter(self.outpath) if is_main_process() \
+            else None
+
+    def unwrap_model(self):
+        """
+        Model without the DistributedDataParallel wrapper, used to save and
+        load state dicts
+        """
+        if isinstance(self.model, DistributedDataParallel):
+            return self.model.module
+        return self.model
 
     # Loop through epochs, train, validate, stop
     def __call__(self):
-        best_stopping_metric = 0
-        tolerance_counter = 0
-        for epoch in range(self.num_epochs):
+        if self.resume and os.path.exists(self.latest_checkpoint_path()):
+            self.load_checkpoint(self.latest_checkpoint_path())
+        if self.profile_steps is not None and is_main_process():
+            self.profiler = profile(
+                schedule=schedule(wait=1, warmup=1, active=self.profile_steps,
+                                  repeat=1),
+                on_trace_ready=tensorboard_trace_handler(
+                    os.path.join(self.outpath, 'profiler')),
+                record_shapes=True,
+                profile_memory=True)
+            self.profiler.start()
+        for epoch in range(self.start_epoch, self.num_epochs):
+            if self.stopped:
+                break
+            set_sampler_epoch(self.train_dataloader, epoch)
             train_metrics = self.train()
-            print(f"Training Loss: {train_metrics['loss']} | "
-                  f"Training AUC: {train_metrics['auc']}")
-
             val_metrics = self.evaluate()
-            print(f"Val Loss: {val_metrics['loss']} | "
-                  f"Val AUC: {val_metrics['auc']}")
+            if is_main_process():
+                print(f"Training Loss: {train_metrics['loss']} | "
+                      f"Training AUC: {train_metrics['auc']}")
+                print(f"Val Loss: {val_metrics['loss']} | "
+                      f"Val AUC: {val_metrics['auc']}")
+
+            if self.writer is not None:
+                self.writer.add_scalar('Loss/train', train_metrics['loss'],
+                                       epoch)
+                self.writer.add_scalar('Loss/val', val_metrics['loss'], epoch)
+                self.writer.add_scalar('AUC/train', train_metrics['auc'],
+                                       epoch)
+                self.writer.add_scalar('AUC/val', val_metrics['auc'], epoch)
+                self.writer.add_scalar(
+                    'LR', self.optimizer.param_groups[0]['lr'], epoch)
 
-            self.writer.add_scalar('Loss/train', train_metrics['loss'], epoch)
-            self.writer.add_scalar('Loss/val', val_metrics['loss'], epoch)
-            self.writer.add_scalar('AUC/train', train_metrics['auc'], epoch)
-            self.writer.add_scalar('AUC/val', val_metrics['auc'], epoch)
+            if self.scheduler is not None:
+                if isinstance(self.scheduler, ReduceLROnPlateau):
+                    self.scheduler.step(val_metrics[self.stopping_metric])
+                else:
+                    self.scheduler.step()
 
-            if tolerance_counter == self.stopping_tolerance:
+            if self.tolerance_counter == self.stopping_tolerance:
+                self.stopped = True
+                self.save_checkpoint(epoch)
                 break
 
             if epoch == 0:
-                best_stopping_metric = val_metrics[self.stopping_metric]
-                torch.save(self.model.state_dict(),
-                           os.path.join(self.outpath, f'model_{epoch}.pt'))
-            elif val_metrics[self.stopping_metric] > best_stopping_metric:
-                best_stopping_metric = val_metrics[self.stopping_metric]
-                tolerance_counter = 0
-                torch.save(self.model.state_dict(),
-                           os.path.join(self.outpath, f'model_{epoch}.pt'))
+                self.best_stopping_metric = val_metrics[self.stopping_metric]
+                self.best_epoch = epoch
+                self.save_model(epoch)
+            elif val_metrics[self.stopping_metric] > \
+                    self.best_stopping_metric:
+                self.best_stopping_metric = val_metrics[self.stopping_metric]
+                self.best_epoch = epoch
+                self.tolerance_counter = 0
+                self.save_model(epoch)
             else:
-                tolerance_counter += 1
-    
+                self.tolerance_counter += 1
+            self.save_checkpoint(epoch)
+
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+        if self.test_dataloader is not None and self.best_epoch is not None:
+            # Wait for rank 0 to finish writing the checkpoint
+            barrier()
+            self.load_best_model()
+            self.save_predictions(self.test_dataloader)
+
+    def latest_checkpoint_path(self):
+        return os.path.join(self.outpath, 'checkpoint_latest.pt')
+
+    def model_path(self, epoch):
+        return os.path.join(self.outpath, f'model_{epoch}.pt')
+
+    def state_dict(self, epoch):
+        """
+        Full training state after epoch. RNG states are those of the saving
+        process (rank 0 when distributed).
+        """
+        return {
+            'model': self.unwrap_model().state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': (self.scheduler.state_dict()
+                          if self.scheduler is not None else None),
+            'rng': get_rng_state(),
+            'epoch': epoch,
+            'global_step': self.global_step,
+            'tolerance_counter': self.tolerance_counter,
+            'best_stopping_metric': self.best_stopping_metric,
+            'best_epoch': self.best_epoch,
+            'stopped': self.stopped
+        }
+
+    def save_checkpoint(self, epoch):
+        """
+        Atomically overwrites checkpoint_latest.pt, on rank 0 only
+        """
+        if is_main_process():
+            atomic_save(self.state_dict(epoch), self.latest_checkpoint_path())
+
+    def load_checkpoint(self, path):
+        """
+        Restores training state saved by save_checkpoint, training resumes at
+        the epoch after the saved one
+        """
+        # Written by this trainer, RNG states need numpy and python objects
+        state = torch.load(path, map_location=self.device, weights_only=False)
+        self.unwrap_model().load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        set_rng_state(state['rng'])
+        self.start_epoch = state['epoch'] + 1
+        self.global_step = state['global_step']
+        self.tolerance_counter = state['tolerance_counter']
+        self.best_stopping_metric = state['best_stopping_metric']
+        self.best_epoch = state['best_epoch']
+        self.stopped = state['stopped']
+
+    def save_model(self, epoch):
+        """
+        Saves the model weights to model_{epoch}.pt as the new best model and
+        deletes the previous best, on rank 0 only. Weights only, so they load
+        with torch.load(weights_only=True).
+        """
+        if not is_main_process():
+            return
+        atomic_save(self.unwrap_model().state_dict(), self.model_path(epoch))
+        for path in os.listdir(self.outpath):
+            if path.startswith('model_') and path.endswith('.pt') and \
+                    path != f'model_{epoch}.pt':
+                os.remove(os.path.join(self.outpath, path))
+
+    def load_best_model(self):
+        """
+        Loads weights of the best checkpoint saved during training
+        """
+        self.unwrap_model().load_state_dict(
+            load_model_state(self.model_path(self.best_epoch),
+                             map_location=self.device))
+
+    def save_predictions(self, dataloader):
+        """
+        Writes predictions on dataloader to {task}_classification_yhats.csv,
+        same layout as the sklearn trainers. Only rank 0 writes the file.
+        """
+        outputs = self.predict(dataloader)
+        if not is_main_process():
+            return None
+        auc = roc_auc_score(outputs['labels'], outputs['predictions'])
+        print(f"{self.task} AUC: {round(auc, 2)}")
+        df_yhats = pd.DataFrame(data={
+            'observation_id': outputs['observation_id'],
+            'labels': outputs['labels'],
+            'predictions': outputs['predictions']
+        })
+        yhats_path = f"{self.task}_classification_yhats.csv"
+        df_yhats.to_csv(os.path.join(self.outpath, yhats_path), index=None)
+        return df_yhats
+
+    def predict(self, dataloader):
+        """
+        Runs model over dataloader without building autograd graphs. Outputs
+        are streamed into arrays preallocated to the dataset size. When
+        distributed, outputs of all ranks are gathered and the duplicates a
+        DistributedSampler pads shards with are dropped by dataset index.
+        Returns:
+            dict with observation_id, labels and predictions (probabilities)
+        """
+        self.model.eval()
+        num_examples = len(dataloader.dataset)
+        predictions = np.empty(num_examples, dtype=np.float32)
+        labels = np.empty(num_examples, dtype=np.int64)
+        observation_ids = np.empty(num_examples, dtype=object)
+        indices = np.empty(num_examples, dtype=object)
+        position = 0
+        with torch.inference_mode():
+            for batch in tqdm(dataloader):
+                sequence = batch['sequence'].to(self.device)
+                seq_lengths = batch['lengths']
+                offsets = batch.get('offsets')
+                if offsets is not None:
+                    offsets = offsets.to(self.device)
+                time_deltas = batch.get('time_deltas')
+                if time_deltas is not None:
+                    time_deltas = time_deltas.to(self.device)
+                output = self.model(sequence.int(), seq_lengths, offsets,
+                                    time_deltas)
+                end = position + len(output)
+                predictions[position:end] = \
+                    torch.sigmoid(output.float()).cpu().numpy()
+                labels[position:end] = batch['labels'].numpy()
+                observation_ids[position:end] = batch['observation_id']
+                indices[position:end] = batch.get('index', [None] * len(output))
+                position = end
+        indices, observation_ids, labels, predictions = all_gather_arrays(
+            indices[:position], observation_ids[:position], labels[:position],
+            predictions[:position])
+        if is_distributed():
+            observation_ids, labels, predictions = drop_padded_duplicates(
+                indices, observation_ids, labels, predictions)
+        return {
+            'observation_id': observation_ids,
+            'labels': labels,
+            'predictions': predictions
+        }
+
     # Enter train round
     def train(self):
         self.model.train()
         train_loss = 0
         predictions, targets = [], []
-        for batch in tqdm(self.train_dataloader):
-            self.model.zero_grad()
+        num_batches = 0
+        accumulation_steps = self.accumulation_steps()
+        window_samples = 0
+        self.model.zero_grad()
+        step_start = time.perf_counter()
+        # The last batch is found by looking ahead, not from len(), which
+        # batch samplers can only estimate
+        batches = mark_last(tqdm(self.train_dataloader))
+        for i, (batch, is_last) in enumerate(batches):
+            num_batches += 1
+            # Time blocked on the dataloader (torch.load, collate)
+            data_time = time.perf_counter() - step_start
+            batch_samples = len(batch['lengths'])
+            window_samples += batch_samples
+            if accumulation_steps is not None:
+                step_optimizer = ((i + 1) % accumulation_steps == 0 or
+                                  is_last)
+            else:
+                step_optimizer = (self.effective_batch_size is None or
+                                  window_samples >= self.effective_batch_size
+                                  or is_last)
             sequence = batch['sequence'].to(self.device)
             seq_lengths = batch['lengths']
+            offsets = batch.get('offsets')
+            if offsets is not None:
+                offsets = offsets.to(self.device)
+            time_deltas = batch.get('time_deltas')
+            if time_deltas is not None:
+                time_deltas = time_deltas.to(self.device)
             labels = batch['labels'].to(self.device)
-            output = self.model(sequence.int(), seq_lengths)
-            loss = self.criterion(output, labels.float())
-            train_loss += loss.item()
-            loss.backward()
-            self.optimizer.step()
+            # DDP decides in forward whether backward all reduces, so the
+            # context covers both
+            with self.accumulation_context(step_optimizer):
+                start = time.perf_counter()
+                output = self.model(sequence.int(), seq_lengths, offsets,
+                                    time_deltas)
+                loss = self.criterion(output, labels.float())
+                train_loss += loss.item()
+                forward_time = time.perf_counter() - start
+                start = time.perf_counter()
+                # Summed over observations here and divided by the window
+                # size before stepping, so the step uses the mean loss over
+                # every observation in the window however batches were sized
+                (loss * batch_samples).backward()
+            backward_time = time.perf_counter() - start
+            start = time.perf_counter()
+            if step_optimizer:
+                # DDP averages gradients over ranks, so dividing by the mean
+                # window size over ranks gives the mean over all of them
+                self.scale_gradients(1 / all_reduce_mean(window_samples))
+                self.optimizer.step()
+                self.model.zero_grad()
+                window_samples = 0
+            optimizer_time = time.perf_counter() - start
             predictions.append(output.cpu().detach().numpy())
             targets.append(labels.cpu().detach().numpy())
-        train_loss /= len(self.train_dataloader)
-        predictions = np.concatenate(predictions)
-        targets = np.concatenate(targets)
+            if self.profiler is not None:
+                self.profiler.step()
+            step_time = time.perf_counter() - step_start
+            if self.global_step % self.log_every == 0:
+                self.log_step(batch, step_time, data_time, forward_time,
+                              backward_time, optimizer_time)
+            self.global_step += 1
+            step_start = time.perf_counter()
+        train_loss /= max(num_batches, 1)
+        train_loss = all_reduce_mean(train_loss)
+        predictions, targets = all_gather_arrays(np.concatenate(predictions),
+                                                 np.concatenate(targets))
         auc = roc_auc_score(targets, predictions)
 
         train_metrics = {
@@ -100,23 +601,100 @@ class SequenceTrainer():
         }
         return train_metrics
 
+    def accumulation_steps(self):
+        """
+        Batches per optimizer step when distributed with effective_batch_size,
+        else None. Ranks must step on the same batch, which sample count
+        windows can't guarantee when batch sizes differ between ranks (token
+        budgets), so the window is a batch count derived from the mean batch
+        size over all ranks.
+        """
+        if self.effective_batch_size is None or not is_distributed():
+            return None
+        batches = getattr(self.train_dataloader.batch_sampler, 'batches',
+                          None)
+        if batches is not None:
+            # Sharded batch sampler, the dataloader's sampler spans all ranks
+            num_samples = sum([len(batch) for batch in batches])
+        else:
+            num_samples = len(self.train_dataloader.sampler)
+        mean_batch_size = all_reduce_mean(
+            num_samples / max(len(self.train_dataloader), 1))
+        return max(1, math.ceil(self.effective_batch_size / mean_batch_size))
+
+    def accumulation_context(self, step_optimizer):
+        """
+        Skips the DistributedDataParallel gradient all reduce on micro
+        batches that don't end an accumulation window
+        """
+        if not step_optimizer and \
+                isinstance(self.model, DistributedDataParallel):
+            return self.model.no_sync()
+        return nullcontext()
+
+    def scale_gradients(self, scale):
+        for param in self.model.parameters():
+            if param.grad is not None:
+                param.grad.mul_(scale)
+
+    def log_step(self, batch, step_time, data_time, forward_time,
+                 backward_time, optimizer_time):
+        """
+        Logs timings (seconds) and throughput of one training step. A high
+        data_wait share of step time means the dataloader is the bottleneck.
+        """
+        if self.writer is None:
+            return
+        num_tokens, padding_ratio = batch_token_stats(batch)
+        step = self.global_step
+        self.writer.add_scalar('Step/data_wait', data_time, step)
+        self.writer.add_scalar('Step/forward', forward_time, step)
+        self.writer.add_scalar('Step/backward', backward_time, step)
+        self.writer.add_scalar('Step/optimizer', optimizer_time, step)
+        self.writer.add_scalar('Step/total', step_time, step)
+        self.writer.add_scalar('Step/data_wait_fraction',
+                               data_time / max(step_time, 1e-9), step)
+        self.writer.add_scalar('Throughput/samples_per_sec',
+                               len(batch['lengths']) / max(step_time, 1e-9),
+                               step)
+        self.writer.add_scalar('Throughput/tokens_per_sec',
+                               num_tokens / max(step_time, 1e-9), step)
+        self.writer.add_scalar('Throughput/padding_ratio', padding_ratio,
+                               step)
+        self.writer.add_scalar('Memory/peak_rss_mb', peak_rss_mb(), step)
+
     # Enter eval round
     def evaluate(self):
         self.model.eval()
         total_loss = 0
-        predictions, targets = [], []
-        for batch in tqdm(self.val_dataloader):
-            sequence = batch['sequence'].to(self.device)
-            seq_lengths = batch['lengths']
-            labels = batch['labels'].to(self.device)
-            output = self.model(sequence.int(), seq_lengths)
-            loss = self.criterion(output, labels.float())
-            total_loss += loss.item()
-            predictions.append(output.cpu().detach().numpy())
-            targets.append(labels.cpu().detach().numpy())
+        predictions, targets, indices = [], [], []
+        with torch.no_grad():
+            for batch in tqdm(self.val_dataloader):
+                sequence = batch['sequence'].to(self.device)
+                seq_lengths = batch['lengths']
+                offsets = batch.get('offsets')
+                if offsets is not None:
+                    offsets = offsets.to(self.device)
+                time_deltas = batch.get('time_deltas')
+                if time_deltas is not None:
+                    time_deltas = time_deltas.to(self.device)
+                labels = batch['labels'].to(self.device)
+                output = self.model(sequence.int(), seq_lengths, offsets,
+                                    time_deltas)
+                loss = self.criterion(output, labels.float())
+                total_loss += loss.item()
+                predictions.append(output.cpu().detach().numpy())
+                targets.append(labels.cpu().detach().numpy())
+                indices.extend(batch.get('index', [None] * len(output)))
         total_loss /= len(self.val_dataloader)
-        predictions = np.concatenate(predictions)
-        targets = np.concatenate(targets)
+        total_loss = all_reduce_mean(total_loss)
+        indices, predictions, targets = all_gather_arrays(
+            np.array(indices, dtype=object), np.concatenate(predictions),
+            np.concatenate(targets))
+        if is_distributed():
+            # AUC over each validation sample once, as in a single process
+            predictions, targets = drop_padded_duplicates(indices, predictions,
+                                                          targets)
         auc = roc_auc_score(targets, predictions)
         metrics = {
             'loss': total_loss,
@@ -0,0 +1,199 @@
+"""
+Definition of GRUHyperparameterSearch, a successive halving search over
+PatientDayGRU hyperparameters run in a process pool.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import json
+import math
+import multiprocessing
+import os
+import time
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+
+from healthrex_ml.datasets.starr_datasets import custom_collate
+from healthrex_ml.datasets.starr_datasets import pack_sequences
+from healthrex_ml.datasets.starr_datasets import PackedSequenceDataset
+from healthrex_ml.models.sequence_models import PatientDayGRU
+from healthrex_ml.trainers.pytorch_trainers import SequenceTrainer
+
+# Lists are sampled uniformly, (low, high) tuples log uniformly
+DEFAULT_GRU_SEARCH_SPACE = {
+    'embedding_size': [128, 256, 512],
+    'hidden_size': [64, 128, 256],
+    'dropout': [0.0, 0.1, 0.2, 0.3],
+    'lr': (1e-4, 3e-3)
+}
+
+
+def sample_config(search_space, rng):
+    config = {}
+    for name, values in search_space.items():
+        if isinstance(values, tuple):
+            low, high = values
+            config[name] = float(np.exp(rng.uniform(np.log(low),
+                                                    np.log(high))))
+        else:
+            config[name] = values[rng.integers(len(values))]
+    return config
+
+
+def run_trial(trial_dir, config, packed_dirs, vocab_size, num_epochs,
+              num_threads, batch_size, seed):
+    """
+    Trains one trial up to num_epochs in its own process, resuming from the
+    trial's latest checkpoint if an earlier rung trained it. Returns the best
+    validation AUC so far.
+    """
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(seed)
+    os.makedirs(trial_dir, exist_ok=True)
+    train_dataset = PackedSequenceDataset(packed_dirs['train'])
+    val_dataset = PackedSequenceDataset(packed_dirs['val'])
+    train_dataloader = DataLoader(train_dataset, batch_size=batch_size,
+                                  shuffle=True, collate_fn=custom_collate)
+    val_dataloader = DataLoader(val_dataset, batch_size=batch_size,
+                                collate_fn=custom_collate)
+    model = PatientDayGRU(vocab_size,
+                          embedding_size=config['embedding_size'],
+                          hidden_size=config['hidden_size'],
+                          dropout=config['dropout'])
+    optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'])
+    trainer = SequenceTrainer(trial_dir, model, torch.nn.BCEWithLogitsLoss(),
+                              optimizer, 'cpu', train_dataloader,
+                              val_dataloader, None, 'auc',
+                              num_epochs=num_epochs, resume=True)
+    start = time.time()
+    trainer()
+    trainer.writer.close()
+    return {
+        'val_auc': trainer.best_stopping_metric,
+        'best_epoch': trainer.best_epoch,
+        'seconds': time.time() - start
+    }
+
+
+class GRUHyperparameterSearch():
+    """
+    Successive halving search over PatientDayGRU hyperparameters. num_trials
+    configs are trained for min_epochs, the best 1 / reduction_factor by
+    validation AUC continue to min_epochs * reduction_factor epochs and so
+    on up to max_epochs. Trials continue from their checkpoints rather than
+    restarting. Trials run num_workers at a time in separate processes with
+    threads_per_trial torch threads each, all reading one memory mapped
+    copy of the train and val sequences.
+    """
+
+    def __init__(self, working_dir, outpath, search_space=None, num_trials=27,
+                 min_epochs=1, max_epochs=9, reduction_factor=3,
+                 num_workers=None, threads_per_trial=None, batch_size=32,
+                 seed=0):
+        """
+        Args:
+            working_dir: outpath of SequenceFeaturizer (train, val dirs and
+                feature_vocab.npz)
+            outpath: directory for trial checkpoints and search_results.csv
+            search_space: dict of hyperparameter to list of values or (low,
+                high) log uniform range, default DEFAULT_GRU_SEARCH_SPACE
+            num_trials: number of configs in the first rung
+            min_epochs: epochs trained by every trial
+            max_epochs: epochs trained by the surviving trials
+            reduction_factor: keep 1 / reduction_factor trials per rung
+            num_workers: concurrent trials, default cores / threads_per_trial
+            threads_per_trial: torch threads per trial, default cores /
+                num_workers, or 1 if neither is given
+            batch_size: training batch size
+            seed: seed for config sampling and trial initialization
+        """
+        self.working_dir = working_dir
+        self.outpath = outpath
+        self.search_space = search_space or DEFAULT_GRU_SEARCH_SPACE
+        self.num_trials = num_trials
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.reduction_factor = reduction_factor
+        num_cores = os.cpu_count() or 1
+        if threads_per_trial is None:
+            threads_per_trial = (max(1, num_cores // num_workers)
+                                 if num_workers is not None else 1)
+        if num_workers is None:
+            num_workers = max(1, num_cores // threads_per_trial)
+        self.num_workers = num_workers
+        self.threads_per_trial = threads_per_trial
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def rung_epochs(self):
+        """
+        Epoch budget of each rung, ex [1, 3, 9]
+        """
+        budgets = [self.min_epochs]
+        while budgets[-1] * self.reduction_factor < self.max_epochs:
+            budgets.append(budgets[-1] * self.reduction_factor)
+        if budgets[-1] < self.max_epochs:
+            budgets.append(self.max_epochs)
+        return budgets
+
+    def pack(self):
+        """
+        Packs train and val sequences once into memory mappable arrays
+        """
+        packed_dirs = {}
+        for split in ['train', 'val']:
+            packed_dir = os.path.join(self.working_dir, f'{split}_packed')
+            if not os.path.exists(os.path.join(packed_dir, 'tokens.npy')):
+                pack_sequences(os.path.join(self.working_dir, split),
+                               packed_dir)
+            packed_dirs[split] = packed_dir
+        return packed_dirs
+
+    def __call__(self):
+        """
+        Runs the search and returns the results table, also saved to
+        {outpath}/search_results.csv with one row per trial and rung
+        """
+        os.makedirs(self.outpath, exist_ok=True)
+        packed_dirs = self.pack()
+        with open(os.path.join(self.working_dir, 'feature_vocab.npz')) as f:
+            vocab_size = max(json.load(f).values())
+        rng = np.random.default_rng(self.seed)
+        trials = {i: sample_config(self.search_space, rng)
+                  for i in range(self.num_trials)}
+
+        results = []
+        alive = list(trials)
+        # Spawn so workers don't inherit the parent's torch thread pools
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.num_workers,
+                                 mp_context=context) as executor:
+            for rung, num_epochs in enumerate(self.rung_epochs()):
+                futures = {
+                    trial: executor.submit(
+                        run_trial, os.path.join(self.outpath, f'trial_{trial}'),
+                        trials[trial], packed_dirs, vocab_size, num_epochs,
+                        self.threads_per_trial, self.batch_size,
+                        self.seed + trial)
+                    for trial in alive
+                }
+                rung_results = []
+                for trial, future in futures.items():
+                    row = {'trial': trial, 'rung': rung, 'epochs': num_epochs}
+                    row.update(trials[trial])
+                    row.update(future.result())
+                    rung_results.append(row)
+                results.extend(rung_results)
+                pd.DataFrame(results).to_csv(
+                    os.path.join(self.outpath, 'search_results.csv'),
+                    index=None)
+                print(f"Rung {rung} ({num_epochs} epochs): best val AUC "
+                      f"{max([r['val_auc'] for r in rung_results])}")
+
+                num_keep = max(1, math.floor(len(alive) /
+                                             self.reduction_factor))
+                ranked = sorted(rung_results, key=lambda r: r['val_auc'],
+                                reverse=True)
+                alive = [r['trial'] for r in ranked[:num_keep]]
+
+        return pd.DataFrame(results)
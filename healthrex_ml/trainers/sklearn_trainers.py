@@ -3,22 +3,30 @@ Definition of ModelTrainer, SequenceTrainer
 """
 from asyncio import Task
 from cmath import exp
+from concurrent.futures import ProcessPoolExecutor
+import inspect
+import multiprocessing
 import os
 import json
+import time
 import pandas as pd
 import pickle
+import tempfile
 import lightgbm as lgb
 from lightgbm import early_stopping
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import roc_auc_score
-from scipy.sparse import load_npz
 from tqdm import tqdm
 
 import sys
 sys.path.append('../../')
 from healthrex_ml.featurizers import DEFAULT_LAB_COMPONENT_IDS
 from healthrex_ml.featurizers import DEFAULT_FLOWSHEET_FEATURES
+from healthrex_ml.datasets.artifacts import load_features
+from healthrex_ml.datasets.artifacts import load_table
+from healthrex_ml.datasets.artifacts import save_csr
+from healthrex_ml.datasets.splits import load_or_create_split
 
 import xgboost as xgb
 from ngboost import NGBRegressor
@@ -26,51 +34,90 @@ from sklearn.metrics import mean_squared_error
 
 import pdb
 
+
+def load_svd_transform(working_dir, use_svd):
+    """
+    Returns the svd projection saved by a featurizer if use_svd, else None
+    """
+    svd_path = os.path.join(working_dir, 'svd_transform.pkl')
+    if not use_svd or not os.path.exists(svd_path):
+        return None
+    with open(svd_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_split_data(working_dir, use_svd=False, features_dir=None):
+    """
+    Reads the train and test features and labels a featurizer saved in
+    working_dir. Pass the result to a trainer's __call__ as data to train
+    several tasks without re-reading them. features_dir, if given, is read
+    for the feature matrices instead of working_dir.
+    """
+    features_dir = features_dir or working_dir
+    return {
+        'X_train': load_features(features_dir, 'train', use_svd),
+        'y_train': load_table(working_dir, 'train_labels'),
+        'X_test': load_features(features_dir, 'test', use_svd),
+        'y_test': load_table(working_dir, 'test_labels')
+    }
+
 class LightGBMTrainer():
     """
     Trains a gbm (LightGBM) and performs appropriate model selection. 
     """
 
-    def __init__(self, working_dir):
+    def __init__(self, working_dir, use_svd=False, n_jobs=None,
+                 val_fraction=0.15, group_column=None):
+        """
+        Args:
+            working_dir: directory with features and labels from a featurizer
+            use_svd: if true train on dense svd compressed features
+            n_jobs: number of threads used by the model, None for its default
+            val_fraction: most recent fraction of training rows held out for
+                validation
+            group_column: if given (ex 'anon_id') validation holds out whole
+                patients so none straddle train and validation
+        """
         self.working_dir = working_dir
+        self.use_svd = use_svd
+        self.n_jobs = n_jobs
+        self.val_fraction = val_fraction
+        self.group_column = group_column
 
-    def __call__(self, task, process_label=False):
+    def __call__(self, task, process_label=False, data=None):
         """
         Trains a model against label defined by task
         Args:
             task: column that has label of interest
+            data: output of load_split_data, read from working_dir if None
         """
         self.task = task
         self.clf = lgb.LGBMClassifier(
             objective='binary',
             n_estimators=1000,
             learning_rate=0.01,
-            num_leaves=32
+            num_leaves=32,
+            n_jobs=self.n_jobs
         )
+        if data is None:
+            data = load_split_data(self.working_dir, self.use_svd)
 
         # Read in train data
-        X_train = load_npz(os.path.join(
-            self.working_dir, 'train_features.npz'))
-        y_train = pd.read_csv(
-            os.path.join(self.working_dir, 'train_labels.csv'))
+        X_train = data['X_train']
+        y_train = data['y_train'].copy()
 
         if process_label:
             y_train = self.process_label(task, y_train)
-        # Remove any rows with missing labels (for censoring tasks)
-        observed_inds = y_train[~y_train[task].isnull()].index
-        X_train = X_train[observed_inds]
-        y_train = y_train.iloc[observed_inds].reset_index()
-
-        # Create val data
-        val_size = int(len(y_train) * 0.15)  # 15 % of training set
-        val_inds = y_train.sort_values('index_time', ascending=False).head(
-            val_size).index.values
+        # Time ordered validation split shared by every task, restricted to
+        # rows with labels (censoring tasks have missing labels)
+        train_mask, val_mask = load_or_create_split(
+            self.working_dir, y_train, self.val_fraction,
+            group_column=self.group_column)
+        observed = ~y_train[task].isnull().values
+        val_inds = np.flatnonzero(val_mask & observed)
+        train_inds = np.flatnonzero(train_mask & observed)
         X_val = X_train[val_inds]
         y_val = y_train.iloc[val_inds]
-
-        # Remove val inds from training set
-        train_inds = [idx for idx in y_train.index.values
-                      if idx not in val_inds]
         X_train = X_train[train_inds]
         y_train = y_train.iloc[train_inds]
 
@@ -80,9 +127,8 @@ class LightGBMTrainer():
         assert len(y_val_obs.intersection(y_train_obs)) == 0
 
         # Read in test data
-        X_test = load_npz(os.path.join(self.working_dir, 'test_features.npz'))
-        y_test = pd.read_csv(
-            os.path.join(self.working_dir, 'test_labels.csv'))
+        X_test = data['X_test']
+        y_test = data['y_test'].copy()
         if process_label:
             y_test = self.process_label(task, y_test)
 
@@ -137,12 +183,12 @@ class LightGBMTrainer():
             4. feature_config: dictionary containing which features types used
                in model and their corresponding look back windows. 
             5. tfidf_transform: if tfidf used to transform feature matrix
+            6. svd_transform: if model trained on svd compressed features
 
         """
         deploy = {}
         deploy['model'] = self.clf
-        feature_order = pd.read_csv(os.path.join(self.working_dir,
-                                                 'feature_order.csv'))
+        feature_order = load_table(self.working_dir, 'feature_order')
         deploy['feature_order'] = [f for f in feature_order.features]
         if os.path.exists(os.path.join(self.working_dir, 'bin_lup.csv')):
             bin_map = pd.read_csv(os.path.join(self.working_dir, 'bin_lup.csv'),
@@ -159,6 +205,8 @@ class LightGBMTrainer():
         else:
             transform = None
         deploy['transform'] = transform
+        deploy['svd_transform'] = load_svd_transform(self.working_dir,
+                                                     self.use_svd)
 
         with open(os.path.join(self.working_dir, 'feature_config.json'),
                   'r') as f:
@@ -177,39 +225,51 @@ class NGBoostTrainer():
     Trains a NGBoost and performs appropriate model selection. 
     """
 
-    def __init__(self, working_dir):
+    def __init__(self, working_dir, use_svd=False, n_jobs=None,
+                 val_fraction=0.15, group_column=None):
+        """
+        Args:
+            working_dir: directory with features and labels from a featurizer
+            use_svd: if true train on dense svd compressed features
+            n_jobs: number of threads used by the model, None for its default
+            val_fraction: most recent fraction of training rows held out for
+                validation
+            group_column: if given (ex 'anon_id') validation holds out whole
+                patients so none straddle train and validation
+        """
         self.working_dir = working_dir
+        self.use_svd = use_svd
+        self.n_jobs = n_jobs
+        self.val_fraction = val_fraction
+        self.group_column = group_column
 
-    def __call__(self, task):
+    def __call__(self, task, data=None):
         """
         Trains a model against label defined by task
         Args:
             task: column that has label of interest
+            data: output of load_split_data, read from working_dir if None
         """
         self.task = task
+        # NGBoost's default tree learner is single threaded, n_jobs is unused
         self.ngb = NGBRegressor()
+        if data is None:
+            data = load_split_data(self.working_dir, self.use_svd)
 
         # Read in train data
-        X_train = load_npz(os.path.join(
-            self.working_dir, 'train_features.npz'))
-        y_train = pd.read_csv(
-            os.path.join(self.working_dir, 'train_labels.csv'))
-
-        # Remove any rows with missing labels (for censoring tasks)
-        observed_inds = y_train[~y_train[task].isnull()].index
-        X_train = X_train[observed_inds]
-        y_train = y_train.iloc[observed_inds].reset_index()
-
-        # Create val data
-        val_size = int(len(y_train) * 0.15)  # 15 % of training set
-        val_inds = y_train.sort_values('index_time', ascending=False).head(
-            val_size).index.values
+        X_train = data['X_train']
+        y_train = data['y_train'].copy()
+
+        # Time ordered validation split shared by every task, restricted to
+        # rows with labels (censoring tasks have missing labels)
+        train_mask, val_mask = load_or_create_split(
+            self.working_dir, y_train, self.val_fraction,
+            group_column=self.group_column)
+        observed = ~y_train[task].isnull().values
+        val_inds = np.flatnonzero(val_mask & observed)
+        train_inds = np.flatnonzero(train_mask & observed)
         X_val = X_train[val_inds]
         y_val = y_train.iloc[val_inds]
-
-        # Remove val inds from training set
-        train_inds = [idx for idx in y_train.index.values
-                      if idx not in val_inds]
         X_train = X_train[train_inds]
         y_train = y_train.iloc[train_inds]
 
@@ -219,9 +279,8 @@ class NGBoostTrainer():
         assert len(y_val_obs.intersection(y_train_obs)) == 0
 
         # Read in test data
-        X_test = load_npz(os.path.join(self.working_dir, 'test_features.npz'))
-        y_test = pd.read_csv(
-            os.path.join(self.working_dir, 'test_labels.csv'))
+        X_test = data['X_test']
+        y_test = data['y_test'].copy()
 
         # Remove censored data from test set
         observed_inds = y_test[~y_test[task].isnull()].index
@@ -262,12 +321,12 @@ class NGBoostTrainer():
             4. feature_config: dictionary containing which features types used
                in model and their corresponding look back windows. 
             5. tfidf_transform: if tfidf used to transform feature matrix
+            6. svd_transform: if model trained on svd compressed features
 
         """
         deploy = {}
         deploy['model'] = self.ngb
-        feature_order = pd.read_csv(os.path.join(self.working_dir,
-                                                 'feature_order.csv'))
+        feature_order = load_table(self.working_dir, 'feature_order')
         deploy['feature_order'] = [f for f in feature_order.features]
         if os.path.exists(os.path.join(self.working_dir, 'bin_lup.csv')):
             bin_map = pd.read_csv(os.path.join(self.working_dir, 'bin_lup.csv'),
@@ -284,6 +343,8 @@ class NGBoostTrainer():
         else:
             transform = None
         deploy['transform'] = transform
+        deploy['svd_transform'] = load_svd_transform(self.working_dir,
+                                                     self.use_svd)
 
         with open(os.path.join(self.working_dir, 'feature_config.json'),
                   'r') as f:
@@ -308,25 +369,33 @@ class BaselineModelTrainer():
     the model itself. 
     """
 
-    def __init__(self, working_dir):
+    def __init__(self, working_dir, use_svd=False, n_jobs=None):
+        """
+        Args:
+            working_dir: directory with features and labels from a featurizer
+            use_svd: if true train on dense svd compressed features
+            n_jobs: number of threads used by the model, None for its default
+        """
         self.working_dir = working_dir
+        self.use_svd = use_svd
+        self.n_jobs = n_jobs
         self.task = None  # useful in multilable scenario
 
-    def __call__(self, task):
+    def __call__(self, task, data=None):
         """
         Trains a model, saves predictions, saves a config file.
         Args:
             task : column for the binary label
+            data: output of load_split_data, read from working_dir if None
         """
         self.task = task
-        self.clf = RandomForestClassifier()
-        X_train = load_npz(os.path.join(
-            self.working_dir, 'train_features.npz'))
-        X_test = load_npz(os.path.join(self.working_dir, 'test_features.npz'))
-        y_train = pd.read_csv(
-            os.path.join(self.working_dir, 'train_labels.csv'))
-        y_test = pd.read_csv(
-            os.path.join(self.working_dir, 'test_labels.csv'))
+        self.clf = RandomForestClassifier(n_jobs=self.n_jobs)
+        if data is None:
+            data = load_split_data(self.working_dir, self.use_svd)
+        X_train = data['X_train']
+        X_test = data['X_test']
+        y_train = data['y_train']
+        y_test = data['y_test']
 
         self.clf.fit(X_train, y_train[self.task])
         predictions = self.clf.predict_proba(X_test)[:, 1]
@@ -351,11 +420,12 @@ class BaselineModelTrainer():
             3. bin_map: numerical features and min value for each bin
             4. feature_config: dictionary containing which features types used
                in model and their corresponding look back windows. 
+            5. tfidf_transform: if tfidf used to transform feature matrix
+            6. svd_transform: if model trained on svd compressed features
         """
         deploy = {}
         deploy['model'] = self.clf
-        feature_order = pd.read_csv(os.path.join(self.working_dir,
-                                                 'feature_order.csv'))
+        feature_order = load_table(self.working_dir, 'feature_order')
         deploy['feature_order'] = [f for f in feature_order.features]
         if os.path.exists(os.path.join(self.working_dir, 'bin_lup.csv')):
             bin_map = pd.read_csv(os.path.join(self.working_dir, 'bin_lup.csv'),
@@ -378,11 +448,122 @@ class BaselineModelTrainer():
         else:
             transform = None
         deploy['transform'] = transform
+        deploy['svd_transform'] = load_svd_transform(self.working_dir,
+                                                     self.use_svd)
 
         with open(os.path.join(self.working_dir, f'{self.task}_deploy.pkl'),
                   'wb') as w:
             pickle.dump(deploy, w)
 
+
+def _train_task(trainer_class, trainer_kwargs, task, task_kwargs,
+                features_dir=None, data=None):
+    """
+    Trains one task. Worker processes pass features_dir and memory map the
+    feature matrices from it.
+    """
+    start = time.time()
+    trainer = trainer_class(**trainer_kwargs)
+    if data is None:
+        data = load_split_data(trainer_kwargs['working_dir'],
+                               trainer_kwargs['use_svd'], features_dir)
+    trainer(task, data=data, **task_kwargs)
+    return {'task': task, 'seconds': time.time() - start}
+
+
+class MultiTaskTrainer():
+    """
+    Trains one of LightGBMTrainer, NGBoostTrainer or BaselineModelTrainer
+    on several label columns of one working directory. With one worker,
+    features and labels are read once and tasks run one after another. With
+    more, tasks run concurrently in worker processes started by a forkserver
+    (forking a parent whose OpenMP threads are already running can hang the
+    children) that memory map one copy of the feature matrices: npy
+    artifacts in place, npz artifacts after they are decompressed once to
+    npy in a temporary directory within working_dir. A total thread budget
+    is split between workers and each model's n_jobs. Every task writes the
+    same *_yhats.csv and *_deploy.pkl as calling the trainer directly.
+    """
+
+    def __init__(self, trainer_class, working_dir, use_svd=False,
+                 num_workers=None, total_threads=None, trainer_kwargs=None):
+        """
+        Args:
+            trainer_class: LightGBMTrainer, NGBoostTrainer or
+                BaselineModelTrainer
+            working_dir: directory with features and labels from a featurizer
+            use_svd: if true train on dense svd compressed features
+            num_workers: number of tasks trained at once, default 1 (tasks
+                run in this process, one after another)
+            total_threads: threads shared by all workers, default all cores
+            trainer_kwargs: other arguments of trainer_class, ex
+                {'group_column': 'anon_id'}
+        """
+        self.trainer_class = trainer_class
+        self.working_dir = working_dir
+        self.use_svd = use_svd
+        self.num_workers = num_workers or 1
+        self.total_threads = total_threads or os.cpu_count() or 1
+        self.trainer_kwargs = trainer_kwargs or {}
+
+    def memmap_features(self, tmp_dir):
+        """
+        Directory workers memory map the feature matrices from. npy artifacts
+        and svd features are mapped from working_dir, npz matrices are
+        written once to tmp_dir as npy.
+        """
+        if self.use_svd or \
+                os.path.isdir(os.path.join(self.working_dir, 'train_features')):
+            return self.working_dir
+        for split in ['train', 'test']:
+            save_csr(load_features(self.working_dir, split), tmp_dir,
+                     f'{split}_features', 'npy')
+        return tmp_dir
+
+    def __call__(self, tasks, **task_kwargs):
+        """
+        Trains a model per task
+        Args:
+            tasks: label columns, ex ['label_WBC', 'label_HGB']
+            task_kwargs: passed to the trainer's __call__, ex
+                process_label=True
+        Returns:
+            dataframe with the training time of each task
+        """
+        num_workers = min(self.num_workers, len(tasks))
+        trainer_kwargs = {
+            'working_dir': self.working_dir,
+            'use_svd': self.use_svd,
+            'n_jobs': max(1, self.total_threads // num_workers),
+            **self.trainer_kwargs
+        }
+        # Build the shared validation split once before workers need it,
+        # with the trainer's split arguments resolved against its defaults
+        params = inspect.signature(self.trainer_class).parameters
+        if 'val_fraction' in params:
+            split_kwargs = {name: trainer_kwargs.get(name, params[name].default)
+                            for name in ['val_fraction', 'group_column']}
+            load_or_create_split(self.working_dir,
+                                 load_table(self.working_dir, 'train_labels'),
+                                 **split_kwargs)
+        if num_workers == 1:
+            data = load_split_data(self.working_dir, self.use_svd)
+            results = [_train_task(self.trainer_class, trainer_kwargs, task,
+                                   task_kwargs, data=data) for task in tasks]
+            return pd.DataFrame(results)
+
+        with tempfile.TemporaryDirectory(dir=self.working_dir) as tmp_dir:
+            features_dir = self.memmap_features(tmp_dir)
+            context = multiprocessing.get_context('forkserver')
+            with ProcessPoolExecutor(max_workers=num_workers,
+                                     mp_context=context) as executor:
+                futures = [executor.submit(_train_task, self.trainer_class,
+                                           trainer_kwargs, task, task_kwargs,
+                                           features_dir)
+                           for task in tasks]
+                results = [future.result() for future in futures]
+        return pd.DataFrame(results)
+
 if __name__ == "__main__":
     
     from healthrex_ml.trainers import LightGBMTrainer